@@ -0,0 +1,402 @@
+#!/usr/bin/python
+
+"""Benchmark for the whole Feedchk -> Fetch -> Isobuild -> Discburn pipeline.
+
+Serves synthetic RSS and Atom feeds and enclosures from a local HTTP server, puts fake genisoimage, wodim, ffmpeg and
+eject executables at the front of the PATH, watches the drives with a FakeMediaMonitor, and runs an AudreyController
+against a temporary working directory until every complete disc's worth of items has been burned. Then reports per-stage latency, throughput, CPU time and peak RSS.
+
+Run with --help to see the options.
+"""
+
+from __future__ import division
+
+import BaseHTTPServer, SocketServer, threading, optparse, tempfile, shutil, hashlib, resource, time, sys, os, re
+
+from lib import *
+
+
+FAKE_GENISOIMAGE = r'''
+import sys, os
+args = sys.argv[1:]
+pathList = args[args.index("-path-list") + 1]
+lines = (pathList == "-" and sys.stdin or open(pathList)).read().splitlines()
+paths = [line.split("=", 1)[1] for line in lines if "=" in line]
+total = sum([os.path.getsize(p) for p in paths])
+if "-print-size" in args:
+	print (total + 2047)//2048 + 16
+	sys.exit(0)
+if "-o" in args:
+	out = open(args[args.index("-o") + 1], "wb")
+else:
+	out = sys.stdout
+out.write("\0"*16*2048) # Stands in for the volume descriptors
+for p in paths:
+	fh = open(p, "rb")
+	while True:
+		chunk = fh.read(1024*1024)
+		if not chunk:
+			break
+		out.write(chunk)
+	fh.close()
+out.write("\0"*((-total) % 2048))
+out.close()
+'''
+
+FAKE_WODIM = r'''
+import sys, os, time
+args = sys.argv[1:]
+dev = [a[4:] for a in args if a.startswith("dev=")][0]
+src = args[-1]
+rate = float(os.environ.get("AUDREY_FAKE_BURN_RATE", "0"))
+fh = (src == "-" and sys.stdin) or open(src, "rb")
+outDir = os.environ.get("AUDREY_FAKE_DEVICE_DIR")
+out = outDir and open(os.path.join(outDir, os.path.basename(dev)), "w+b")
+size = 0
+start = time.time()
+while True:
+	chunk = fh.read(1024*1024)
+	if not chunk:
+		break
+	size += len(chunk)
+	if out:
+		out.write(chunk)
+	if rate > 0:
+		time.sleep(max(start + size/rate - time.time(), 0))
+countPath = outDir and os.path.join(outDir, "bad-burns")
+badBurns = int(os.environ.get("AUDREY_FAKE_BAD_BURNS", "0"))
+if out and badBurns > 0:
+	done = (os.path.exists(countPath) and int(open(countPath).read())) or 0
+	if done < badBurns:
+		open(countPath, "w").write(str(done + 1))
+		out.seek(size//2)
+		byte = out.read(1)
+		out.seek(size//2)
+		out.write(chr(ord(byte) ^ 0xff)) # Spoil one byte in the middle of the disc
+		print "Fake wodim spoiled the disc"
+mediaDir = os.environ.get("AUDREY_FAKE_MEDIA_DIR")
+if mediaDir:
+	open(os.path.join(mediaDir, os.path.basename(dev)), "w").write("full") # For the FakeMediaMonitor
+print "Fake wodim wrote %u bytes to %s" % (size, dev)
+'''
+
+FAKE_EJECT = r'''
+'''
+
+FAKE_FFMPEG = r'''
+import sys
+args = sys.argv[1:]
+data = open(args[args.index("-i") + 1], "rb").read()
+open(args[-1], "wb").write(data[:len(data)//2]) # As though re-encoded at half the bitrate
+'''
+
+
+class BenchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""An HTTP server for synthetic feeds and enclosures, configured by the benchmark's options."""
+	
+	daemon_threads = True
+	allow_reuse_address = True
+	
+	def __init__(self, options):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), BenchHandler)
+		self.options = options
+		self.bytesServed = 0
+		self._lock = threading.Lock()
+	
+	def baseUrl(self):
+		return "http://127.0.0.1:%u" % self.server_port
+	
+	def countBytes(self, n):
+		self._lock.acquire()
+		try:
+			self.bytesServed += n
+		finally:
+			self._lock.release()
+
+
+class BenchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+	
+	def do_GET(self):
+		time.sleep(self.server.options.latency/1000)
+		m = re.match(r"^/feed/(\d+)\.xml$", self.path)
+		if m is not None:
+			return self._sendFeed(int(m.group(1)))
+		m = re.match(r"^/enc/(\d+)/(\d+)\.mp3$", self.path)
+		if m is not None:
+			return self._sendEnclosure()
+		self.send_error(404)
+	
+	def _sendFeed(self, feedNum):
+		opts = self.server.options
+		base = self.server.baseUrl()
+		size = opts.sizeKb*1024
+		now = time.time()
+		entries = []
+		for n in range(opts.entries):
+			entryTime = now - (n + 1)*60*60
+			encUrl = "%s/enc/%u/%u.mp3" % (base, feedNum, n)
+			if opts.atom and feedNum % 2 == 1:
+				entries.append(
+					'<entry><title>Episode %u</title><id>%s</id><updated>%s</updated><link rel="enclosure" href="%s" length="%u" type="audio/mpeg"/></entry>' % (
+						n, encUrl, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entryTime)), encUrl, size,
+					)
+				)
+			else:
+				entries.append(
+					'<item><title>Episode %u</title><guid>%s</guid><pubDate>%s</pubDate><enclosure url="%s" length="%u" type="audio/mpeg"/></item>' % (
+						n, encUrl, time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(entryTime)), encUrl, size,
+					)
+				)
+		if opts.atom and feedNum % 2 == 1:
+			body = '<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom"><title>Bench Feed %u</title><id>feed-%u</id>%s</feed>' % (feedNum, feedNum, "".join(entries))
+		else:
+			body = '<?xml version="1.0"?><rss version="2.0"><channel><title>Bench Feed %u</title>%s</channel></rss>' % (feedNum, "".join(entries))
+		self.send_response(200)
+		self.send_header("Content-Type", "application/xml")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def _sendEnclosure(self):
+		size = self.server.options.sizeKb*1024
+		block = hashlib.sha1(self.path).digest()*(64*1024//20 + 1) # Different content for every enclosure, so nothing is deduplicated
+		block = block[:64*1024]
+		self.send_response(200)
+		self.send_header("Content-Type", "audio/mpeg")
+		self.send_header("Content-Length", str(size))
+		self.send_header("ETag", '"%s"' % hashlib.sha1(self.path).hexdigest())
+		self.end_headers()
+		sent = 0
+		while sent < size:
+			chunk = block[:min(len(block), size - sent)]
+			self.wfile.write(chunk)
+			sent += len(chunk)
+		self.server.countBytes(sent)
+
+
+class StageTracker:
+	"""Watches the working directory and records when each working file appears and disappears."""
+	
+	def __init__(self, workingDir):
+		self.workingDir = workingDir
+		self.appeared = {}
+		self.vanished = {}
+		self.descTitles = {} # Maps fetch-desc-* files to the titles inside them
+		self.watcher = WorkingDirWatcher(workingDir, self._changed)
+	
+	def _changed(self, fn, present):
+		if present:
+			self.appeared.setdefault(fn, time.time())
+			if fn.startswith("fetch-desc-"):
+				try:
+					fh = open(os.path.join(self.workingDir, fn))
+					fh.readline()
+					self.descTitles[fn] = fh.readline().strip()
+					fh.close()
+				except IOError:
+					pass
+		else:
+			self.vanished.setdefault(fn, time.time())
+	
+	def poll(self, timeout):
+		self.watcher.wait(("",), timeout)
+	
+	def present(self, prefix):
+		return self.watcher.files(prefix)
+	
+	def everPresent(self, prefix):
+		return [fn for fn in self.appeared if fn.startswith(prefix)]
+
+
+class ProcSampler:
+	"""Samples the CPU time and resident set size of the controller's subprocesses from /proc.
+	
+	Stages running as threads of this process are skipped, since they're counted in the controller's own usage."""
+	
+	def __init__(self, subprocs):
+		self._subprocs = subprocs
+		self._ticks = os.sysconf("SC_CLK_TCK")
+		self.cpu = {} # Maps stage names to CPU seconds, including reaped children such as genisoimage
+		self.peakRss = {} # Maps stage names to peak RSS in KB
+	
+	def sample(self):
+		for p in self._subprocs:
+			name = p.__class__.__name__
+			try:
+				pid = p.getPid()
+				if pid == os.getpid():
+					continue
+				fields = open("/proc/%u/stat" % pid).read().rsplit(")", 1)[1].split()
+				self.cpu[name] = sum([int(x) for x in fields[11:15]])/self._ticks # utime, stime, cutime, cstime
+				for line in open("/proc/%u/status" % pid):
+					if line.startswith("VmRSS:"):
+						self.peakRss[name] = max(self.peakRss.get(name, 0), int(line.split()[1]))
+			except (IOError, TypeError):
+				pass
+
+
+def installFakeTools(binDir):
+	"""Writes the fake genisoimage, wodim, eject and ffmpeg executables into binDir."""
+	for (name, body) in (("genisoimage", FAKE_GENISOIMAGE), ("wodim", FAKE_WODIM), ("eject", FAKE_EJECT), ("ffmpeg", FAKE_FFMPEG)):
+		path = os.path.join(binDir, name)
+		fh = open(path, "w")
+		fh.write("#!%s\nfrom __future__ import division\n%s" % (sys.executable, body))
+		fh.close()
+		os.chmod(path, 0755)
+
+
+def loadBlankDisc(mediaDir, device):
+	"""Puts a blank disc in a fake drive, as far as its FakeMediaMonitor can tell."""
+	fh = open(os.path.join(mediaDir, os.path.basename(device)), "w")
+	fh.write("blank")
+	fh.close()
+
+
+def summarize(values):
+	"""Returns a (count, mean, median, max) tuple for a list of numbers."""
+	if len(values) == 0:
+		return (0, 0, 0, 0)
+	values = sorted(values)
+	return (len(values), sum(values)/len(values), values[len(values)//2], values[-1])
+
+
+def runBenchmark(options):
+	baseDir = tempfile.mkdtemp(prefix = "audrey-bench-")
+	workingDir = os.path.join(baseDir, "working")
+	binDir = os.path.join(baseDir, "bin")
+	deviceDir = os.path.join(baseDir, "devices")
+	mediaDir = os.path.join(baseDir, "media")
+	for d in (workingDir, binDir, deviceDir, mediaDir):
+		os.mkdir(d)
+	installFakeTools(binDir)
+	os.environ["PATH"] = "%s:%s" % (binDir, os.environ.get("PATH", ""))
+	os.environ["AUDREY_FAKE_BURN_RATE"] = str(options.burnRateKb*1024)
+	os.environ["AUDREY_FAKE_DEVICE_DIR"] = deviceDir
+	os.environ["AUDREY_FAKE_BAD_BURNS"] = str(options.badBurns)
+	os.environ["AUDREY_FAKE_MEDIA_DIR"] = mediaDir
+	
+	server = BenchServer(options)
+	serverThread = threading.Thread(target = server.serve_forever)
+	serverThread.setDaemon(True)
+	serverThread.start()
+	
+	for n in range(options.feeds):
+		fh = open(os.path.join(workingDir, "feedchk-url-bench%03u" % n), "w")
+		fh.write("%s/feed/%u.xml\n" % (server.baseUrl(), n))
+		fh.close()
+		fh = open(os.path.join(workingDir, "feedchk-status-bench%03u" % n), "w")
+		fh.write("2000,1,1,0,0,0\nNone\n") # So that every entry counts as new
+		fh.close()
+	
+	# Size the discs so that exactly options.discItems items fill one
+	itemMb = options.sizeKb/1024
+	if options.transcode:
+		itemMb /= 2 # The fake ffmpeg halves every item
+	IsobuildProcess.MAX_SIZE = itemMb*(options.discItems + 0.5)
+	IsobuildProcess.TRIP_SIZE = itemMb*(options.discItems - 0.5)
+	
+	AudreyController.SINGLE_PROCESS = options.singleProcess
+	FetchProcess.TRANSCODE = options.transcode
+	DiscburnProcess.DRIVES = [os.path.join(deviceDir, "fakecd%u" % n) for n in range(options.drives)] # Plain files, so that discs can be read back for verification
+	DiscburnProcess.MEDIA_MONITOR = "fake"
+	FakeMediaMonitor.FAKE_DIR = mediaDir
+	for device in DiscburnProcess.DRIVES:
+		loadBlankDisc(mediaDir, device)
+	
+	totalItems = options.feeds*min(options.entries, 3) # FeedchkProcess takes at most 3 new entries per check
+	expectedBurned = (totalItems//options.discItems)*options.discItems
+	
+	controller = AudreyController(workingDir)
+	tracker = StageTracker(workingDir)
+	startTime = time.time()
+	controller.start()
+	sampler = ProcSampler(controller._subprocs)
+	deadline = startTime + options.timeout
+	finished = False
+	try:
+		hungry = set()
+		lastEat = 0
+		while time.time() < deadline:
+			controller.pump()
+			# Play an attentive user, who swaps discs and clicks 'Eat!' as soon as a drive asks
+			nowHungry = set([device for (device, status) in controller.driveStatus() if status == "Needs a blank disc"])
+			# A drive can go from hungry to burning and back between two pumps, so click again if one stays hungry
+			if len(nowHungry - hungry) > 0 or (len(nowHungry) > 0 and time.time() - lastEat >= 1):
+				for device in nowHungry:
+					loadBlankDisc(mediaDir, device)
+				controller.pushEvent("EatButtonPushed")
+				lastEat = time.time()
+			hungry = nowHungry
+			tracker.poll(0.05)
+			sampler.sample()
+			burned = len([fn for fn in tracker.everPresent("isobuild-item-") if fn in tracker.vanished])
+			if burned >= expectedBurned and len(tracker.present("discburn-")) == 0 and len(tracker.present("temp-discburn-")) == 0:
+				finished = True
+				break
+	finally:
+		endTime = time.time()
+		controller.stop()
+		server.shutdown()
+	
+	elapsed = endTime - startTime
+	
+	feedchkLatencies = [tracker.appeared[fn] - startTime for fn in tracker.everPresent("fetch-desc-")]
+	fetchLatencies = []
+	for (desc, title) in tracker.descTitles.items():
+		item = "isobuild-item-%s.mp3" % title
+		if item in tracker.appeared:
+			fetchLatencies.append(tracker.appeared[item] - tracker.appeared[desc])
+	items = tracker.everPresent("isobuild-item-")
+	isobuildLatencies = [tracker.vanished[fn] - tracker.appeared[fn] for fn in items if fn in tracker.vanished]
+	discs = tracker.everPresent("discburn-iso-") + tracker.everPresent("discburn-stream-")
+	discburnLatencies = [tracker.vanished[fn] - tracker.appeared[fn] for fn in discs if fn in tracker.vanished]
+	
+	print "Audrey pipeline benchmark: %u feeds, %u entries each, %u KB enclosures, %u ms latency, %u items per disc" % (
+		options.feeds, options.entries, options.sizeKb, options.latency, options.discItems,
+	)
+	if not finished:
+		print "TIMED OUT after %.1f s, results are partial" % elapsed
+	print
+	print "%-10s %7s %10s %10s %10s" % ("Stage", "Count", "Mean (s)", "Median (s)", "Max (s)")
+	for (name, latencies) in (("feedchk", feedchkLatencies), ("fetch", fetchLatencies), ("isobuild", isobuildLatencies), ("discburn", discburnLatencies)):
+		print "%-10s %7u %10.3f %10.3f %10.3f" % ((name,) + summarize(latencies))
+	print
+	burned = len(isobuildLatencies)
+	print "Burned %u of %u items on %u discs in %.2f s" % (burned, totalItems, len(discburnLatencies), elapsed)
+	print "Throughput: %.2f items/s, %.1f KB/s downloaded" % (burned/elapsed, server.bytesServed/1024/elapsed)
+	print
+	print "%-18s %10s %14s" % ("Process", "CPU (s)", "Peak RSS (KB)")
+	for name in sorted(sampler.cpu.keys()):
+		print "%-18s %10.2f %14u" % (name, sampler.cpu[name], sampler.peakRss.get(name, 0))
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	print "%-18s %10.2f %14u" % ("AudreyController", usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+	
+	if options.keep:
+		print
+		print "Kept working files in %s" % baseDir
+	else:
+		shutil.rmtree(baseDir, ignore_errors = True)
+	
+	return finished
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage = "%prog [options]")
+	parser.add_option("--feeds", type = "int", default = 10, help = "number of synthetic feeds [%default]")
+	parser.add_option("--entries", type = "int", default = 3, help = "entries per feed [%default]")
+	parser.add_option("--size-kb", dest = "sizeKb", type = "int", default = 1024, help = "size of each enclosure in KB [%default]")
+	parser.add_option("--latency-ms", dest = "latency", type = "int", default = 50, help = "delay before each HTTP response in ms [%default]")
+	parser.add_option("--disc-items", dest = "discItems", type = "int", default = 6, help = "items that fill one disc [%default]")
+	parser.add_option("--burn-rate-kb", dest = "burnRateKb", type = "int", default = 0, help = "fake burner speed in KB/s, 0 for instant [%default]")
+	parser.add_option("--atom", action = "store_true", default = False, help = "serve every other feed as Atom instead of RSS")
+	parser.add_option("--drives", type = "int", default = 1, help = "number of fake burner drives [%default]")
+	parser.add_option("--single-process", dest = "singleProcess", action = "store_true", default = False, help = "run the stages as threads of one process")
+	parser.add_option("--bad-burns", dest = "badBurns", type = "int", default = 0, help = "spoil this many of the fake burns, so that they fail verification [%default]")
+	parser.add_option("--transcode", action = "store_true", default = False, help = "re-encode items with a fake ffmpeg that halves their size")
+	parser.add_option("--timeout", type = "int", default = 600, help = "give up after this many seconds [%default]")
+	parser.add_option("--keep", action = "store_true", default = False, help = "keep the working directory afterwards")
+	(options, args) = parser.parse_args()
+	if not runBenchmark(options):
+		sys.exit(1)
@@ -27,11 +27,17 @@ class MainWindow:
 		# Status message
 		self.statusMsg = gtk.Label("Status"); self.statusMsg.set_line_wrap(True); winBox.pack_start(self.statusMsg)
 		
+		# Per-drive status, one label for each burner
+		self.driveBox = gtk.VBox(spacing = 2); winBox.pack_start(self.driveBox, expand = False)
+		self.driveLabels = {}
+		
 		# The 'Eat!' button
 		self.eatBtn = gtk.Button("Eat!"); self.eatBtn.connect("clicked", self.eatClicked); winBox.pack_start(self.eatBtn, expand = False, padding = 30)
 		
-		# Run the tick method every 50 ms
-		gobject.timeout_add(50, self.tick)
+		# Run the tick method whenever the subprocesses send messages, and at least once a second
+		self.watches = {} # Maps file descriptors to their io watch source ids
+		self.watchChannels()
+		gobject.timeout_add(int(self.controller.PUMP_INTERVAL*1000), self.tick)
 		
 		# Okay, we've prepared everything, let's show the window
 		self.window.show_all(); self.window.set_focus(None)
@@ -39,17 +45,36 @@ class MainWindow:
 	def eatClicked(self, widget):
 		self.controller.pushEvent("EatButtonPushed")
 	
+	def watchChannels(self):
+		"""Watches each of the controller's message channels. They change when a stage is restarted."""
+		fds = self.controller.filenos()
+		for fd in self.watches.keys():
+			if fd not in fds:
+				gobject.source_remove(self.watches.pop(fd))
+		for fd in fds:
+			if fd not in self.watches:
+				self.watches[fd] = gobject.io_add_watch(fd, gobject.IO_IN, self.messagesReady)
+	
+	def messagesReady(self, source, condition):
+		return self.tick()
+	
 	def tick(self):
 		try:
 			self.window.deiconify() # Dumb trick to keep the window from iconifying. There must be a better way to do this, but I can't find it.
 			statusMsg = self.controller.pump()
+			self.watchChannels()
 			self.statusMsg.set_text(statusMsg)
+			for (device, status) in self.controller.driveStatus():
+				if device not in self.driveLabels:
+					self.driveLabels[device] = gtk.Label(); self.driveBox.pack_start(self.driveLabels[device]); self.driveLabels[device].show()
+				self.driveLabels[device].set_text("%s: %s" % (device, status))
 			return True
 		except:
 			self.quit()
 	
 	def quit(self, widget = None):
 		self.window.destroy()
+		self.controller.stop() # Writes out the rest of the log before the exit below kills its thread
 		gtk.main_quit()
 		sys.exit() # Necessary to kill off any running threads/subprocesses
 
@@ -2,7 +2,27 @@
 
 from __future__ import division
 
-import feedparser, time, datetime, traceback, urllib, os, random, subprocess, re, processing, Queue, socket
+import BaseHTTPServer, sys, feedparser, time, datetime, traceback, urlparse, httplib, base64, os, random, subprocess, re, processing, Queue, socket, threading, heapq, hashlib, select, struct, ctypes, ctypes.util, math, signal, tempfile, gzip, shutil, zlib, fcntl, mmap, errno
+import xml.etree.cElementTree as etree
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+try:
+	import json
+except ImportError:
+	json = None
+
+
+class SpaceExhausted(IOError):
+	"""Raised when a SpaceBudget can't make a reservation."""
+	pass
+
+
+class StageStopped(Exception):
+	"""Raised inside a stage running as a StageThread once the controller has asked it to stop."""
+	pass
 
 
 class AudreyProcess(processing.Process):
@@ -12,25 +32,115 @@ class AudreyProcess(processing.Process):
 	
 	Data attributes:
 	workingDir - Path to the working directory.
+	watcher - A WorkingDirWatcher for the working directory, created when the process starts running.
+	store - A StateStore, created when the process starts running, or None if the store is disabled or unavailable.
+	metrics - A Metrics object for recording counters, gauges and timings. Sent to the controller by pullEvent(), waitForFiles()
+		and waitForEvent() when they've changed, at most every METRICS_INTERVAL seconds. Time spent idle is only sent along
+		with other changes, so that an idle process stays asleep.
+	budget - A SpaceBudget to reserve space in before writing big files.
+	channel - The MessageChannel that log, status and metrics messages are sent to. Must be set before the process is started.
+	
+	Worker pools, threads and child processes should be started with makePool(), startThread() and startChild(), so that
+	they can be stopped when doStuff() returns or raises. Otherwise a restarted process could find them still at work.
 	"""
 	
+	USE_STATE_STORE = True # Track feeds and items in a StateStore, if the sqlite3 module is available
+	METRICS_INTERVAL = 5 # Send metrics to the controller at most this often, in seconds
+	TEMP_PREFIXES = () # Prefixes of the temp- files this process writes, which are deleted before it is restarted
+	STOP_TIMEOUT = 30 # When stopping, wait at most this long for worker threads to finish, in seconds
+	
 	def __init__(self, workingDir):
 		super(AudreyProcess, self).__init__()
 		self.workingDir = workingDir
-		self._logQueue = processing.Queue()
-		self._statusQueue = processing.Queue()
+		self.watcher = None
+		self.store = None
+		self.metrics = Metrics()
+		self.budget = SpaceBudget(workingDir, self.__class__.__name__)
+		self._lastMetricsSent = 0
+		self._metricsVersionSent = None
+		self._idleSeconds = 0 # Idle time not yet added to the metrics
+		self.channel = None
 		self._eventQueue = processing.Queue()
+		self._stopRequested = False
+		self._pools = []
+		self._threads = []
+		self._children = []
+		self._childLock = threading.Lock()
 	
 	def run(self):
 		try:
-			self.doStuff()
-		except:
-			self.logMsg("Uncaught exception in subprocess! Traceback:\n%s" % traceback.format_exc())
+			try:
+				self.watcher = WorkingDirWatcher(self.workingDir) # Created here so that each process gets its own inotify descriptor
+				self.store = openStateStore(self.workingDir, self.USE_STATE_STORE)
+				self.doStuff()
+			except StageStopped:
+				pass
+			except:
+				self.logMsg("Uncaught exception in subprocess! Traceback:\n%s" % traceback.format_exc())
+		finally:
+			self._stopWorkers()
+			# In single-process mode nothing else would close these when a stage is restarted
+			if self.watcher is not None:
+				self.watcher.close()
+			if self.store is not None:
+				self.store.close()
+	
+	def makePool(self, maxWorkers, maxPerHost, errorCallback = None):
+		"""Returns a new HostLimitedPool, which is closed when the process stops."""
+		pool = HostLimitedPool(maxWorkers, maxPerHost, errorCallback)
+		self._pools.append(pool)
+		return pool
+	
+	def startThread(self, target, args = ()):
+		"""Starts a daemon thread running target(*args), which is waited for when the process stops. It should return once pullEvent() would raise StageStopped."""
+		t = threading.Thread(target = target, args = args)
+		t.setDaemon(True)
+		self._threads.append(t)
+		t.start()
+		return t
+	
+	def startChild(self, args, **kwargs):
+		"""Starts and returns a subprocess.Popen, which is killed if the process stops. Raises StageStopped if it's stopping already."""
+		self._childLock.acquire()
+		try:
+			if self._stopRequested:
+				raise StageStopped()
+			p = subprocess.Popen(args, **kwargs)
+			self._children = [c for c in self._children if c.returncode is None] + [p] # Only the thread that started a child may poll it
+			return p
+		finally:
+			self._childLock.release()
+	
+	def _stopWorkers(self):
+		"""Kills the child processes and waits up to STOP_TIMEOUT seconds for the pools and threads to finish."""
+		self._childLock.acquire()
+		try:
+			self._stopRequested = True
+			for p in self._children:
+				if p.returncode is None:
+					try:
+						os.kill(p.pid, signal.SIGTERM)
+					except OSError:
+						pass # It has already exited
+		finally:
+			self._childLock.release()
+		deadline = time.time() + self.STOP_TIMEOUT
+		for pool in self._pools:
+			pool.close(max(deadline - time.time(), 0))
+		for t in self._threads:
+			t.join(max(deadline - time.time(), 0))
+		busy = sum([len(pool.busyKeys()) for pool in self._pools]) + len([t for t in self._threads if t.isAlive()])
+		if busy > 0:
+			self.logMsg("%u workers still running after %u seconds, giving up on them" % (busy, self.STOP_TIMEOUT))
 	
 	def pullEvent(self):
 		"""Returns a string with the latest input event, or None if there is no such event.
 		
 		Must be called periodically by doStuff()."""
+		if self._stopRequested:
+			raise StageStopped()
+		self._sendMetrics()
+		
 		r = None
 		try:
 			while True:
@@ -40,29 +150,1446 @@ class AudreyProcess(processing.Process):
 	
 	def logMsg(self, msg):
 		"""Emits a log message."""
-		self._logQueue.put(msg)
+		self.channel.send("log", self.__class__.__name__, msg)
 	
 	def statusMsg(self, msg):
 		"""Sets a status message. This is used for showing cd burner state information."""
-		self._statusQueue.put(msg)
+		self.channel.send("status", self.__class__.__name__, msg)
+	
+	def _metricsDue(self):
+		"""Returns the number of seconds until changed metrics may be sent, or None if nothing has changed since they were last sent."""
+		if self.metrics.version == self._metricsVersionSent:
+			return None
+		return max(self._lastMetricsSent + self.METRICS_INTERVAL - time.time(), 0)
+	
+	def _sendMetrics(self):
+		"""Sends the metrics to the controller if they've changed and METRICS_INTERVAL has passed since they were last sent."""
+		if self.budget.highWater > 0: # Only processes that write big files use the budget
+			self.metrics.setGauge("working_set_high_water_bytes", self.budget.highWater)
+		if self._metricsDue() != 0:
+			return
+		self.metrics.count("idle_seconds_total", self._idleSeconds)
+		self._idleSeconds = 0
+		self._metricsVersionSent = self.metrics.version
+		self.channel.send("metrics", self.__class__.__name__, self.metrics.snapshot())
+		self._lastMetricsSent = time.time()
+	
+	def _idle(self, waitFunc, timeout):
+		"""Calls waitFunc(timeout), counting the time spent as idle time, and returns what it returns.
+		
+		If metrics change shortly before, the wait is broken up so that they're sent once METRICS_INTERVAL has passed."""
+		start = time.time()
+		deadline = start + timeout
+		try:
+			while not self._stopRequested:
+				self._sendMetrics()
+				remaining = max(deadline - time.time(), 0)
+				due = self._metricsDue()
+				if due is None or due >= remaining:
+					return waitFunc(remaining)
+				r = waitFunc(due)
+				if r:
+					return r
+		finally:
+			self._idleSeconds += time.time() - start
+			if self._stopRequested:
+				raise StageStopped()
+	
+	def waitForFiles(self, prefixes, timeout):
+		"""Calls watcher.wait(), counting the time spent waiting as idle time."""
+		return self._idle(lambda t: self.watcher.wait(prefixes, t), timeout)
+	
+	def waitForEvent(self, timeout):
+		"""Sleeps until an input event arrives or timeout seconds pass, counting the time as idle time. Returns the event, or None."""
+		def nextEvent(t):
+			try:
+				return self._eventQueue.get(True, t)
+			except Queue.Empty:
+				return None
+		return self._idle(nextEvent, timeout)
+	
+	def writeWorkingFile(self, fn, lines):
+		"""Atomically writes a working file with the given lines, by writing a temp- file and then renaming it into place."""
+		tempPath = os.path.join(self.workingDir, "temp-%s" % fn)
+		fh = open(tempPath, "w")
+		try:
+			for line in lines:
+				fh.write("%s\n" % line)
+		finally:
+			fh.close()
+		os.rename(tempPath, os.path.join(self.workingDir, fn))
 	
 	def doStuff(self):
 		raise NotImplementedError
 
 
+class MessageChannel:
+	"""A pipe carrying messages from one subprocess to the controller.
+	
+	Each message is a (kind, source, payload) tuple, where kind is "log", "status", "drives" or "metrics" and source is the sending process's class name.
+	The read end has a file descriptor, so the controller can wait for messages with select() or a GUI main loop instead of polling.
+	
+	Each subprocess gets a channel of its own, so one that dies or stalls in the middle of a send can't hold up the others.
+	A restarted subprocess gets a new channel, in case the old one was left with half a message in it.
+	"""
+	
+	def __init__(self):
+		(self._reader, self._writer) = processing.Pipe(duplex = False)
+		self._lock = threading.Lock() # Only the threads within one process write to the pipe
+	
+	def send(self, kind, source, payload):
+		self._lock.acquire()
+		try:
+			self._writer.send((kind, source, payload))
+		finally:
+			self._lock.release()
+	
+	def fileno(self):
+		"""Returns the file descriptor that becomes readable when messages are waiting."""
+		return self._reader.fileno()
+	
+	def receive(self):
+		"""Returns a list of all the messages that are waiting, without blocking."""
+		r = []
+		while self._reader.poll():
+			r.append(self._reader.recv())
+		return r
+	
+	def close(self):
+		self._reader.close()
+		self._writer.close()
+
+
+class Metrics:
+	"""Counters, gauges and timing histograms recorded by an AudreyProcess, in a form that can be exported to Prometheus.
+	
+	Safe to use from several threads at once.
+	"""
+	
+	BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800) # Upper bounds of the histogram buckets, in seconds
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._gauges = {}
+		self._histograms = {} # Maps names to [per-bucket counts, sum, count] lists
+		self.version = 0 # Goes up whenever any value changes
+	
+	def count(self, name, amount = 1):
+		"""Adds amount to a counter."""
+		self._lock.acquire()
+		try:
+			self._counters[name] = self._counters.get(name, 0) + amount
+			self.version += 1
+		finally:
+			self._lock.release()
+	
+	def setGauge(self, name, value):
+		self._lock.acquire()
+		try:
+			if name not in self._gauges or self._gauges[name] != value:
+				self._gauges[name] = value
+				self.version += 1
+		finally:
+			self._lock.release()
+	
+	def observe(self, name, value):
+		"""Adds a timing, in seconds, to a histogram."""
+		self._lock.acquire()
+		try:
+			if name not in self._histograms:
+				self._histograms[name] = [[0]*len(self.BUCKETS), 0, 0]
+			h = self._histograms[name]
+			for i in range(len(self.BUCKETS)):
+				if value <= self.BUCKETS[i]:
+					h[0][i] += 1
+			h[1] += value
+			h[2] += 1
+			self.version += 1
+		finally:
+			self._lock.release()
+	
+	def snapshot(self):
+		"""Returns a picklable copy of the current values, as a (counters, gauges, histograms) tuple of dictionaries."""
+		self._lock.acquire()
+		try:
+			return (
+				dict(self._counters),
+				dict(self._gauges),
+				dict([(name, (list(h[0]), h[1], h[2])) for (name, h) in self._histograms.items()]),
+			)
+		finally:
+			self._lock.release()
+
+
+def formatMetrics(snapshots):
+	"""Returns Prometheus text exposition format for a dictionary mapping stage names to Metrics snapshots."""
+	lines = []
+	def series(kind, name, rows):
+		lines.append("# TYPE audrey_%s %s" % (name, kind))
+		lines.extend(rows)
+	
+	names = {}
+	for (stage, (counters, gauges, histograms)) in snapshots.items():
+		for name in counters:
+			names[name] = "counter"
+		for name in gauges:
+			names[name] = "gauge"
+		for name in histograms:
+			names[name] = "histogram"
+	
+	for name in sorted(names):
+		rows = []
+		for stage in sorted(snapshots):
+			(counters, gauges, histograms) = snapshots[stage]
+			if name in counters:
+				rows.append('audrey_%s{stage="%s"} %s' % (name, stage, repr(counters[name])))
+			elif name in gauges:
+				rows.append('audrey_%s{stage="%s"} %s' % (name, stage, repr(gauges[name])))
+			elif name in histograms:
+				(buckets, total, count) = histograms[name]
+				for i in range(len(Metrics.BUCKETS)):
+					rows.append('audrey_%s_bucket{stage="%s",le="%s"} %u' % (name, stage, Metrics.BUCKETS[i], buckets[i]))
+				rows.append('audrey_%s_bucket{stage="%s",le="+Inf"} %u' % (name, stage, count))
+				rows.append('audrey_%s_sum{stage="%s"} %s' % (name, stage, repr(total)))
+				rows.append('audrey_%s_count{stage="%s"} %u' % (name, stage, count))
+		series(names[name], name, rows)
+	return "".join(["%s\n" % line for line in lines])
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves the controller's metrics at /metrics. The server must have a controller attribute."""
+	
+	def do_GET(self):
+		if self.path != "/metrics":
+			self.send_error(404)
+			return
+		body = self.server.controller.metricsText()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, format, *args):
+		pass
+
+
+class WorkingDirWatcher:
+	"""Keeps an in-memory index of the files in a directory, and lets a process sleep until files it cares about show up.
+	
+	Uses inotify where the C library supports it, and otherwise falls back to rescanning the directory every POLL_INTERVAL
+	seconds. File sizes and modification times are cached in the index and only re-read when the file changes.
+	
+	The index only catches up with changes when wait() or refresh() is called. Only one thread should call wait() at a
+	time, but the other methods may be called from any thread. wake() makes a wait() in progress return early.
+	"""
+	
+	POLL_INTERVAL = 5 # When inotify isn't available, rescan the directory this often, in seconds
+	
+	# Flags from <sys/inotify.h>
+	IN_ATTRIB = 0x4
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_FROM = 0x40
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_DELETE = 0x200
+	IN_Q_OVERFLOW = 0x4000
+	
+	def __init__(self, path, listener = None):
+		"""Creates the watcher. If given, listener is called with a file name and True or False whenever a file is seen to appear or disappear."""
+		self.path = path
+		self._listener = listener
+		self._lock = threading.Lock()
+		self._index = {} # Maps file names to (size, mtime) tuples, or to None if they haven't been statted yet
+		self._lastScan = 0
+		self._fd = self._initInotify()
+		(self._wakeReader, self._wakeWriter) = os.pipe()
+		for fd in (self._wakeReader, self._wakeWriter):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self._rescan()
+	
+	def _initInotify(self):
+		"""Returns an inotify file descriptor watching the directory, or None if inotify is unavailable."""
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+			fd = libc.inotify_init()
+		except (OSError, AttributeError):
+			return None
+		if fd < 0:
+			return None
+		mask = self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+		if libc.inotify_add_watch(fd, self.path, mask) < 0:
+			os.close(fd)
+			return None
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK) # So that refresh() never blocks
+		return fd
+	
+	def refresh(self):
+		"""Brings the index up to date with any changes since the last call to wait() or refresh(), without sleeping."""
+		if self._fd is None:
+			self._rescan()
+		else:
+			self._readEvents()
+	
+	def files(self, prefix = ""):
+		"""Returns a sorted list of the names of the files in the directory which start with prefix."""
+		if self._fd is None and time.time() - self._lastScan >= self.POLL_INTERVAL:
+			self._rescan()
+		self._lock.acquire()
+		try:
+			return sorted([fn for fn in self._index if fn.startswith(prefix)])
+		finally:
+			self._lock.release()
+	
+	def stat(self, fn):
+		"""Returns a (size in bytes, mtime) tuple for a file in the directory, or None if there's no such file."""
+		self._lock.acquire()
+		try:
+			if fn in self._index and self._index[fn] is not None:
+				return self._index[fn]
+		finally:
+			self._lock.release()
+		try:
+			st = os.stat(os.path.join(self.path, fn))
+		except OSError:
+			return None
+		r = (st.st_size, st.st_mtime)
+		self._lock.acquire()
+		try:
+			if fn in self._index:
+				self._index[fn] = r
+		finally:
+			self._lock.release()
+		return r
+	
+	def wait(self, prefixes, timeout):
+		"""Sleeps until a file starting with one of the given prefixes is created or renamed into the directory, or until timeout seconds have passed.
+		
+		Returns True if such a file showed up, False on timeout."""
+		deadline = time.time() + timeout
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return False
+			if self._fd is None:
+				(r, w, x) = select.select([self._wakeReader], [], [], min(remaining, max(self._lastScan + self.POLL_INTERVAL - time.time(), 0)))
+				if self._woken(r):
+					return False
+				if time.time() - self._lastScan >= self.POLL_INTERVAL:
+					for fn in self._rescan():
+						if self._matches(fn, prefixes):
+							return True
+			else:
+				(r, w, x) = select.select([self._fd, self._wakeReader], [], [], remaining)
+				if self._woken(r):
+					return False
+				if self._fd in r:
+					for fn in self._readEvents():
+						if self._matches(fn, prefixes):
+							return True
+	
+	def close(self):
+		"""Closes the inotify descriptor and the wake() pipe."""
+		for fd in (self._fd, self._wakeReader, self._wakeWriter):
+			if fd is not None:
+				os.close(fd)
+		self._fd = self._wakeReader = self._wakeWriter = None
+	
+	def wake(self):
+		"""Makes the current or next call to wait() return False straight away. May be called from any thread."""
+		try:
+			os.write(self._wakeWriter, "x")
+		except (OSError, TypeError):
+			pass # The pipe is full, so wait() will wake anyway, or the watcher is closed
+	
+	def _woken(self, readable):
+		if self._wakeReader not in readable:
+			return False
+		try:
+			while os.read(self._wakeReader, 4096):
+				pass
+		except OSError:
+			pass # Drained
+		return True
+	
+	def _matches(self, fn, prefixes):
+		for prefix in prefixes:
+			if fn.startswith(prefix):
+				return True
+		return False
+	
+	def _rescan(self):
+		"""Rebuilds the index from a directory listing. Returns a list of names that weren't in the index before."""
+		names = os.listdir(self.path)
+		self._lock.acquire()
+		try:
+			added = [fn for fn in names if fn not in self._index]
+			newIndex = dict([(fn, self._index.get(fn)) for fn in names])
+			removed = [fn for fn in self._index if fn not in newIndex]
+			self._index = newIndex
+			self._lastScan = time.time()
+		finally:
+			self._lock.release()
+		if self._listener is not None:
+			for fn in added:
+				self._listener(fn, True)
+			for fn in removed:
+				self._listener(fn, False)
+		return added
+	
+	def _readEvents(self):
+		"""Reads pending inotify events and updates the index. Returns a list of names that were created or renamed into place."""
+		try:
+			buf = os.read(self._fd, 64*1024)
+		except OSError, e:
+			if e.errno == errno.EAGAIN: # Another thread's refresh() got to them first
+				return []
+			raise
+		added = []
+		offset = 0
+		while offset + 16 <= len(buf):
+			(wd, mask, cookie, nameLen) = struct.unpack_from("iIII", buf, offset)
+			fn = buf[offset + 16:offset + 16 + nameLen].rstrip("\0")
+			offset += 16 + nameLen
+			if mask & self.IN_Q_OVERFLOW:
+				added.extend(self._rescan()) # We missed some events, so start over
+				continue
+			if fn == "":
+				continue
+			self._lock.acquire()
+			try:
+				present = None # Becomes True or False if the file has appeared or disappeared
+				if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+					if fn in self._index:
+						del self._index[fn]
+						present = False
+				else:
+					if fn not in self._index:
+						present = True
+					self._index[fn] = None # Stat it again next time it's asked for
+					if mask & (self.IN_CREATE | self.IN_MOVED_TO | self.IN_CLOSE_WRITE):
+						added.append(fn)
+			finally:
+				self._lock.release()
+			if self._listener is not None and present is not None:
+				self._listener(fn, present)
+		return added
+
+
+class StateStore:
+	"""An SQLite database that tracks every feed and item as it moves through the pipeline.
+	
+	The working files are still what hands work from one stage to the next; the store sits alongside them to answer
+	"have we seen this item before?" and "how much is waiting in each stage?" without reading any files. Items are
+	identified by a key, which is the entry's GUID if the feed gives one and its enclosure URL otherwise.
+	
+	Each process opens its own connection. Safe to use from several threads at once.
+	"""
+	
+	FILENAME = "state.db"
+	
+	SCHEMA = (
+		"CREATE TABLE IF NOT EXISTS feeds (name TEXT PRIMARY KEY, url TEXT, last_checked REAL, last_entry_time REAL)",
+		"CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, feed TEXT, enclosure_url TEXT, title TEXT, entry_time REAL, stage TEXT, filename TEXT, updated REAL, original_size INTEGER, size INTEGER)",
+		"CREATE INDEX IF NOT EXISTS items_feed ON items (feed)",
+		"CREATE INDEX IF NOT EXISTS items_enclosure_url ON items (enclosure_url)",
+		"CREATE INDEX IF NOT EXISTS items_stage ON items (stage)",
+		"CREATE INDEX IF NOT EXISTS items_filename ON items (filename)",
+	)
+	
+	ADDED_COLUMNS = (("items", "original_size", "INTEGER"), ("items", "size", "INTEGER")) # Columns missing from databases made by older versions
+	
+	def __init__(self, workingDir):
+		self._lock = threading.Lock()
+		self._conn = sqlite3.connect(os.path.join(workingDir, self.FILENAME), timeout = 60, check_same_thread = False)
+		try:
+			self._conn.execute("PRAGMA journal_mode=WAL") # Lets the other processes read while one is writing
+		except sqlite3.DatabaseError:
+			pass
+		self._transaction(lambda c: [c.execute(stmt) for stmt in self.SCHEMA])
+		self._transaction(self._addColumns)
+	
+	def _addColumns(self, c):
+		for (table, column, colType) in self.ADDED_COLUMNS:
+			c.execute("PRAGMA table_info(%s)" % table)
+			if column not in [row[1] for row in c.fetchall()]:
+				try:
+					c.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, colType))
+				except sqlite3.OperationalError:
+					pass # Another process added it first
+	
+	def _transaction(self, func):
+		"""Calls func with a cursor inside a transaction, committing if it returns and rolling back if it raises. Returns what func returned."""
+		self._lock.acquire()
+		try:
+			try:
+				r = func(self._conn.cursor())
+				self._conn.commit()
+				return r
+			except:
+				self._conn.rollback()
+				raise
+		finally:
+			self._lock.release()
+	
+	def hasSeen(self, key, enclosureUrl = None):
+		"""Returns True if an item with the given key or enclosure url has been recorded before."""
+		def f(c):
+			c.execute("SELECT 1 FROM items WHERE key = ? OR enclosure_url = ? LIMIT 1", (key, enclosureUrl or key))
+			return c.fetchone() is not None
+		return self._transaction(f)
+	
+	def feedChecked(self, name, url, lastEntryTime):
+		def f(c):
+			c.execute("INSERT OR REPLACE INTO feeds (name, url, last_checked, last_entry_time) VALUES (?, ?, ?, ?)", (name, url, time.time(), lastEntryTime))
+		self._transaction(f)
+	
+	def addItem(self, key, feed, enclosureUrl, title, entryTime, filename):
+		"""Records a newly found item as waiting in the fetch stage as the given fetch-desc-* file."""
+		def f(c):
+			c.execute(
+				"INSERT OR IGNORE INTO items (key, feed, enclosure_url, title, entry_time, stage, filename, updated) VALUES (?, ?, ?, ?, ?, 'fetch', ?, ?)",
+				(key, feed, enclosureUrl, title, entryTime, filename, time.time())
+			)
+		self._transaction(f)
+	
+	def setStage(self, key, stage, filename, enclosureUrl = None):
+		"""Moves one item to a new stage, in which it is represented by the given working file. Unknown items are added."""
+		def f(c):
+			c.execute("UPDATE items SET stage = ?, filename = ?, updated = ? WHERE key = ?", (stage, filename, time.time(), key))
+			if c.rowcount == 0:
+				c.execute(
+					"INSERT INTO items (key, enclosure_url, stage, filename, updated) VALUES (?, ?, ?, ?, ?)",
+					(key, enclosureUrl, stage, filename, time.time())
+				)
+		self._transaction(f)
+	
+	def moveFiles(self, filenames, stage, newFilename):
+		"""Moves every item represented by one of the given working files to a new stage, all in one transaction."""
+		def f(c):
+			for fn in filenames:
+				c.execute("UPDATE items SET stage = ?, filename = ?, updated = ? WHERE filename = ?", (stage, newFilename, time.time(), fn))
+		self._transaction(f)
+	
+	def recordSizes(self, filename, originalSize, size):
+		"""Records the size in bytes of the items represented by the given working file, before and after re-encoding."""
+		def f(c):
+			c.execute("UPDATE items SET original_size = ?, size = ? WHERE filename = ?", (originalSize, size, filename))
+		self._transaction(f)
+	
+	def close(self):
+		self._conn.close()
+	
+	def pendingByStage(self):
+		"""Returns a dictionary mapping each stage name to the number of items waiting in it. Burned and dropped items are left out."""
+		def f(c):
+			c.execute("SELECT stage, COUNT(*) FROM items WHERE stage NOT IN ('burned', 'dropped') GROUP BY stage")
+			return dict(c.fetchall())
+		return self._transaction(f)
+
+
+def readPathList(path):
+	"""Returns the (in-ISO name, full path) tuples from a genisoimage path list file, such as a discburn-stream-* file."""
+	fh = open(path)
+	try:
+		return [tuple(line.rstrip("\n").split("=", 1)) for line in fh if "=" in line]
+	finally:
+		fh.close()
+
+
+def openStateStore(workingDir, enabled = True):
+	"""Returns a StateStore for the working directory, or None if it's disabled or the sqlite3 module isn't available."""
+	if not enabled or sqlite3 is None:
+		return None
+	try:
+		return StateStore(workingDir)
+	except sqlite3.Error:
+		return None
+
+
+class DigestIndex:
+	"""A persistent record of the SHA-1 digest and URL of every enclosure that has been downloaded.
+	
+	Stored as a text file with one "digest url" line per download, which is loaded into memory when the index is
+	created and appended to as new downloads are recorded. Safe to use from several threads at once.
+	"""
+	
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._digests = set()
+		self._urls = set()
+		if os.path.exists(path):
+			fh = open(path)
+			try:
+				for line in fh:
+					parts = line.strip().split(" ", 1)
+					if len(parts) == 2:
+						self._digests.add(parts[0])
+						self._urls.add(parts[1])
+			finally:
+				fh.close()
+	
+	def hasDigest(self, digest):
+		self._lock.acquire()
+		try:
+			return digest in self._digests
+		finally:
+			self._lock.release()
+	
+	def hasUrl(self, url):
+		self._lock.acquire()
+		try:
+			return url in self._urls
+		finally:
+			self._lock.release()
+	
+	def add(self, digest, url):
+		self._lock.acquire()
+		try:
+			fh = open(self.path, "a")
+			try:
+				fh.write("%s %s\n" % (digest, url))
+			finally:
+				fh.close()
+			self._digests.add(digest)
+			self._urls.add(url)
+		finally:
+			self._lock.release()
+
+
+class SpaceBudget:
+	"""Shares out the space available to the working directory among all the processes that write to it.
+	
+	Before writing a big file, a process reserves the space it will need. A reservation is a space-reserve-<owner>-* working
+	file holding the number of bytes reserved and the path being written; only the part of it that hasn't been written
+	yet counts against the budget. The budget is the free disk space less MIN_FREE, and also, if LIMIT is set, LIMIT less
+	the size of the working directory. Safe to use from several threads and processes at once.
+	"""
+	
+	LIMIT = None # Never let the working directory grow beyond this many bytes, or None for no limit besides the disk
+	MIN_FREE = 256*1024*1024 # Always leave this many bytes of the disk free
+	LOCK_FILE = "space-lock"
+	
+	def __init__(self, workingDir, owner):
+		"""Creates the budget. owner names the reservations made through it, so that they can be cleaned up if it dies."""
+		self.workingDir = workingDir
+		self.owner = owner
+		self.highWater = 0 # The largest working directory size seen by usage(), which reserve() and release() also call
+		self._lock = threading.Lock()
+		self._count = 0
+	
+	def usage(self):
+		"""Returns the total size in bytes of the files in the working directory. Files being written are statted afresh, so no WorkingDirWatcher here."""
+		total = 0
+		for fn in os.listdir(self.workingDir):
+			try:
+				total += os.path.getsize(os.path.join(self.workingDir, fn))
+			except OSError:
+				pass
+		self.highWater = max(self.highWater, total)
+		return total
+	
+	def reserved(self):
+		"""Returns the number of reserved bytes that haven't been written yet."""
+		total = 0
+		for fn in os.listdir(self.workingDir):
+			if fn.startswith("space-reserve-"):
+				try:
+					fh = open(os.path.join(self.workingDir, fn))
+					try:
+						(size, path) = fh.read().split("\n", 1)
+					finally:
+						fh.close()
+					size = int(size)
+				except (IOError, ValueError):
+					continue # Being written or deleted
+				try:
+					size -= os.path.getsize(path.strip())
+				except OSError:
+					pass
+				total += max(size, 0)
+		return total
+	
+	def available(self):
+		"""Returns the number of bytes that may still be reserved."""
+		st = os.statvfs(self.workingDir)
+		available = st.f_bavail*st.f_frsize - self.MIN_FREE
+		if self.LIMIT is not None:
+			available = min(available, self.LIMIT - self.usage())
+		return available - self.reserved()
+	
+	def reserve(self, size, path, keep = 0):
+		"""Reserves size bytes for writing path. Returns the reservation's working file name, to be passed to release() once path is written.
+		
+		Raises SpaceExhausted if there isn't enough space, or if the reservation would leave less than keep bytes for others."""
+		lockFh = open(os.path.join(self.workingDir, self.LOCK_FILE), "a")
+		try:
+			fcntl.flock(lockFh.fileno(), fcntl.LOCK_EX) # Keeps other processes from reserving the same space at the same time
+			self.usage()
+			available = self.available() - keep
+			if size > available:
+				raise SpaceExhausted("Need %.1f MB for %s, only %.1f MB left" % (size/(1024*1024), os.path.basename(path), max(available, 0)/(1024*1024)))
+			self._lock.acquire()
+			try:
+				self._count += 1
+				fn = "space-reserve-%s-%u-%u" % (self.owner, os.getpid(), self._count)
+			finally:
+				self._lock.release()
+			fh = open(os.path.join(self.workingDir, fn), "w")
+			try:
+				fh.write("%u\n%s\n" % (size, path))
+			finally:
+				fh.close()
+			return fn
+		finally:
+			lockFh.close() # Releases the lock
+	
+	def release(self, fn):
+		"""Ends a reservation made by reserve()."""
+		self.usage() # The file has just been written, so this is when the working directory is biggest
+		path = os.path.join(self.workingDir, fn)
+		if os.path.exists(path):
+			os.unlink(path)
+
+
+class HostLimitedPool:
+	"""A pool of worker threads that runs jobs concurrently, but never runs more than a set number of jobs against any one host at once.
+	
+	Jobs are identified by a key. A job whose key is already pending or running is not queued again, so that a slow job
+	can't pile up duplicates of itself. Pending jobs with a higher priority are started first; priorities may be any
+	comparable values, and jobs with equal priorities are started in the order they were submitted.
+	"""
+	
+	def __init__(self, maxWorkers, maxPerHost, errorCallback = None):
+		"""Creates the pool. If given, errorCallback is called with the key and a traceback string whenever a job raises an exception."""
+		self.maxWorkers = maxWorkers
+		self.maxPerHost = maxPerHost
+		self._errorCallback = errorCallback
+		self._cond = threading.Condition()
+		self._pending = [] # A list of (key, host, func, args, priority) tuples, in the order they were submitted
+		self._running = {} # Maps the keys of running jobs to their hosts
+		self._hostCounts = {} # Maps hosts to the number of jobs currently running against them
+		self._workers = []
+		self._closed = False
+	
+	def submit(self, key, host, func, args = (), priority = 0):
+		"""Queues func(*args) to be called on a worker thread. Returns False if a job with the same key is already pending or running.
+		
+		Resubmitting a job that is still pending updates its priority. Nothing can be submitted once the pool is closed."""
+		self._cond.acquire()
+		try:
+			if key in self._running or self._closed:
+				return False
+			for i in range(len(self._pending)):
+				if self._pending[i][0] == key:
+					self._pending[i] = self._pending[i][:4] + (priority,)
+					return False
+			self._pending.append((key, host, func, args, priority))
+			if len(self._workers) < self.maxWorkers:
+				t = threading.Thread(target = self._work)
+				t.setDaemon(True)
+				self._workers.append(t)
+				t.start()
+			self._cond.notifyAll()
+			return True
+		finally:
+			self._cond.release()
+	
+	def pendingKeys(self):
+		"""Returns a sorted list of the keys of the jobs that haven't started yet."""
+		self._cond.acquire()
+		try:
+			return sorted([job[0] for job in self._pending])
+		finally:
+			self._cond.release()
+	
+	def busyKeys(self):
+		"""Returns a sorted list of the keys of all pending and running jobs."""
+		self._cond.acquire()
+		try:
+			return sorted(self._running.keys() + [job[0] for job in self._pending])
+		finally:
+			self._cond.release()
+	
+	def close(self, timeout):
+		"""Drops any pending jobs, and waits up to timeout seconds for the running ones to finish. The worker threads exit once idle."""
+		deadline = time.time() + timeout
+		self._cond.acquire()
+		try:
+			self._closed = True
+			self._pending = []
+			self._cond.notifyAll()
+			while len(self._running) > 0 and time.time() < deadline:
+				self._cond.wait(deadline - time.time())
+		finally:
+			self._cond.release()
+	
+	def _nextJob(self):
+		# The condition must be held by the caller
+		best = None
+		for i in range(len(self._pending)):
+			if self._hostCounts.get(self._pending[i][1], 0) < self.maxPerHost:
+				if best is None or self._pending[i][4] > self._pending[best][4]:
+					best = i
+		if best is None:
+			return None
+		return self._pending.pop(best)
+	
+	def _work(self):
+		while True:
+			self._cond.acquire()
+			try:
+				job = self._nextJob()
+				while job is None:
+					if self._closed:
+						return
+					self._cond.wait()
+					job = self._nextJob()
+				(key, host, func, args, priority) = job
+				self._running[key] = host
+				self._hostCounts[host] = self._hostCounts.get(host, 0) + 1
+			finally:
+				self._cond.release()
+			
+			try:
+				func(*args)
+			except StageStopped:
+				pass
+			except:
+				if self._errorCallback is not None:
+					self._errorCallback(key, traceback.format_exc())
+			
+			self._cond.acquire()
+			try:
+				del self._running[key]
+				self._hostCounts[host] -= 1
+				self._cond.notifyAll()
+			finally:
+				self._cond.release()
+
+
+class TokenBucket:
+	"""A token bucket for limiting a rate shared between threads, such as download bandwidth in bytes per second.
+	
+	Callers that take more than is available go into debt and sleep it off, so the combined rate of all callers stays
+	at the limit no matter how many there are.
+	"""
+	
+	def __init__(self, rate = None, burst = None):
+		"""Creates the bucket. A rate of None means unlimited. The burst size defaults to one second's worth of tokens."""
+		self._lock = threading.Lock()
+		self._tokens = 0
+		self._last = time.time()
+		self.rate = None
+		self.burst = None
+		self.setRate(rate, burst)
+	
+	def setRate(self, rate, burst = None):
+		"""Changes the rate limit. Does nothing if it is unchanged."""
+		self._lock.acquire()
+		try:
+			if rate == self.rate:
+				return
+			self.rate = rate
+			if rate is not None:
+				self.burst = burst or rate
+			self._tokens = 0
+			self._last = time.time()
+		finally:
+			self._lock.release()
+	
+	def consume(self, amount):
+		"""Takes amount tokens from the bucket, sleeping as long as necessary to stay within the rate limit."""
+		self._lock.acquire()
+		try:
+			if self.rate is None:
+				return
+			now = time.time()
+			self._tokens = min(self.burst, self._tokens + (now - self._last)*self.rate)
+			self._last = now
+			self._tokens -= amount
+			delay = -self._tokens/self.rate
+		finally:
+			self._lock.release()
+		if delay > 0:
+			time.sleep(delay)
+
+
+class FeedScheduler:
+	"""Decides when each feed is next due to be checked, based on how often it has been publishing.
+	
+	A feed is checked CHECKS_PER_GAP times per typical gap between its entries, kept within MIN_INTERVAL and MAX_INTERVAL.
+	Every check that turns up nothing new (including 304 Not Modified responses and errors) stretches the interval by BACKOFF,
+	and a check that finds new entries resets the stretch. Due times are jittered so feeds don't all fall due together.
+	
+	Safe to use from several threads at once.
+	"""
+	
+	MIN_INTERVAL = 15*60 # Never check a feed more often than this many seconds
+	MAX_INTERVAL = 24*60*60 # Always check a feed at least this often
+	DEFAULT_INTERVAL = 60*60 # Interval for feeds whose publishing cadence isn't known yet
+	CHECKS_PER_GAP = 4 # How many times to check per typical gap between entries
+	BACKOFF = 1.25 # Interval multiplier for each check in a row that found nothing new
+	MAX_BACKOFF_STEPS = 8 # Stop stretching the interval after this many quiet checks in a row
+	JITTER = 0.1 # Randomly vary each interval by up to this fraction either way
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._heap = [] # A heap of (due time, feed) tuples; entries that don't match self._due are stale
+		self._due = {} # Maps each scheduled feed to its due time
+		self._entryTimes = {} # Maps feeds to the sorted timestamps of their most recent entries
+		self._quietChecks = {} # Maps feeds to the number of checks in a row that found nothing new
+	
+	def add(self, feed, delay = 0):
+		"""Schedules a feed to be checked after delay seconds, unless it is already scheduled."""
+		self._lock.acquire()
+		try:
+			if feed not in self._due:
+				self._schedule(feed, time.time() + delay)
+		finally:
+			self._lock.release()
+	
+	def remove(self, feed):
+		"""Forgets all about a feed."""
+		self._lock.acquire()
+		try:
+			for d in (self._due, self._entryTimes, self._quietChecks):
+				if feed in d:
+					del d[feed]
+		finally:
+			self._lock.release()
+	
+	def feeds(self):
+		"""Returns a list of every feed that is scheduled."""
+		self._lock.acquire()
+		try:
+			return self._due.keys()
+		finally:
+			self._lock.release()
+	
+	def popDue(self, now = None):
+		"""Returns a list of the feeds that are due to be checked, and unschedules them until feedChecked() is called."""
+		if now is None:
+			now = time.time()
+		due = []
+		self._lock.acquire()
+		try:
+			while len(self._heap) > 0 and self._heap[0][0] <= now:
+				(dueTime, feed) = heapq.heappop(self._heap)
+				if self._due.get(feed) == dueTime:
+					del self._due[feed]
+					due.append(feed)
+		finally:
+			self._lock.release()
+		return due
+	
+	def nextDueTime(self):
+		"""Returns the time at which the next feed falls due, or None if nothing is scheduled."""
+		self._lock.acquire()
+		try:
+			if len(self._due) == 0:
+				return None
+			return min(self._due.values())
+		finally:
+			self._lock.release()
+	
+	def feedChecked(self, feed, entryTimes, foundNew):
+		"""Reschedules a feed after a check. entryTimes is a list of timestamps of its recent entries, or None if unknown.
+		
+		Returns the number of seconds until the feed's next check."""
+		self._lock.acquire()
+		try:
+			if entryTimes is not None:
+				self._entryTimes[feed] = sorted(entryTimes)
+			if foundNew:
+				self._quietChecks[feed] = 0
+			else:
+				self._quietChecks[feed] = self._quietChecks.get(feed, 0) + 1
+			interval = self._interval(feed)
+			self._schedule(feed, time.time() + interval)
+			return interval
+		finally:
+			self._lock.release()
+	
+	def _interval(self, feed):
+		times = self._entryTimes.get(feed, [])
+		gaps = sorted([b - a for (a, b) in zip(times, times[1:]) if b > a])
+		if len(gaps) > 0:
+			# A feed that has gone quiet for longer than its usual gap shouldn't be checked at its old rate forever
+			gap = max(gaps[len(gaps)//2], time.time() - times[-1])
+			interval = gap/self.CHECKS_PER_GAP
+		else:
+			interval = self.DEFAULT_INTERVAL
+		interval *= self.BACKOFF ** min(self._quietChecks.get(feed, 0), self.MAX_BACKOFF_STEPS)
+		interval = min(max(interval, self.MIN_INTERVAL), self.MAX_INTERVAL)
+		return interval * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+	
+	def _schedule(self, feed, dueTime):
+		# The lock must be held by the caller
+		self._due[feed] = dueTime
+		heapq.heappush(self._heap, (dueTime, feed))
+
+
+class HttpCache:
+	"""An on-disk record of the ETag and Last-Modified validators last seen for each URL, for making conditional GET requests.
+	
+	Each URL has its own httpcache-* file in the working directory, named by a hash of the URL and containing three lines:
+	URL, ETag, Last-Modified. Validators should only be stored once the response they came with has been fully dealt with,
+	so that a failure part way through means the resource is fetched again in full next time.
+	"""
+	
+	def __init__(self, workingDir):
+		self.workingDir = workingDir
+	
+	def _path(self, url):
+		return os.path.join(self.workingDir, "httpcache-%s" % hashlib.sha1(url).hexdigest())
+	
+	def validators(self, url):
+		"""Returns an (etag, modified) tuple of strings or Nones."""
+		try:
+			fh = open(self._path(url))
+		except IOError:
+			return (None, None)
+		try:
+			lines = [line.strip() for line in fh.readlines()]
+		finally:
+			fh.close()
+		if len(lines) < 3 or lines[0] != url:
+			return (None, None)
+		return tuple([(x != "None" and x) or None for x in lines[1:3]])
+	
+	def conditionalHeaders(self, url):
+		"""Returns a dictionary of request headers that make a GET request for url conditional on it having changed."""
+		(etag, modified) = self.validators(url)
+		headers = {}
+		if etag is not None:
+			headers["If-None-Match"] = etag
+		if modified is not None:
+			headers["If-Modified-Since"] = modified
+		return headers
+	
+	def store(self, url, etag, modified):
+		if etag is None and modified is None:
+			self.forget(url)
+			return
+		path = self._path(url)
+		tempPath = os.path.join(self.workingDir, "temp-%s" % os.path.basename(path))
+		fh = open(tempPath, "w")
+		try:
+			fh.write("%s\n%s\n%s\n" % (url, etag, modified))
+		finally:
+			fh.close()
+		os.rename(tempPath, path)
+	
+	def forget(self, url):
+		if os.path.exists(self._path(url)):
+			os.unlink(self._path(url))
+	
+	def prune(self, urls):
+		"""Deletes the records for every URL not in urls."""
+		keep = set([os.path.basename(self._path(url)) for url in urls])
+		for fn in os.listdir(self.workingDir):
+			if fn.startswith("httpcache-") and fn not in keep:
+				os.unlink(os.path.join(self.workingDir, fn))
+
+
+class DecompressingReader:
+	"""File-like wrapper that decompresses a gzip or deflate encoded stream as it's read."""
+	
+	def __init__(self, fh, encoding):
+		self._fh = fh
+		if encoding == "gzip":
+			self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		else:
+			self._decompressor = zlib.decompressobj()
+	
+	def read(self, size = 16*1024):
+		while True:
+			data = self._fh.read(size)
+			if not data:
+				return self._decompressor.flush()
+			out = self._decompressor.decompress(data)
+			if out:
+				return out
+	
+	def close(self):
+		self._fh.close()
+
+
+class HttpResponse:
+	"""A response from an HttpClient.
+	
+	Read the body with read(), then call close() to hand the connection back to the pool. Also has the info(), url and
+	status attributes that feedparser looks for, so it can be passed straight to feedparser.parse().
+	
+	Data attributes:
+	status - The HTTP status code.
+	headers - The response headers, as an httplib.HTTPMessage.
+	url - The URL the response came from, after following any redirects.
+	permanentUrl - The URL that the requested one has permanently moved to, or None if it hasn't moved.
+	expired - True once the deadline given to setDeadline() has passed.
+	"""
+	
+	def __init__(self, client, key, conn, raw, url, permanentUrl, decompress):
+		self._client = client
+		self._key = key
+		self._conn = conn
+		self._raw = raw
+		self.status = raw.status
+		self.headers = raw.msg
+		self.url = url
+		self.permanentUrl = permanentUrl
+		self.expired = False
+		self._lock = threading.Lock()
+		self._timer = None
+		encoding = (raw.getheader("Content-Encoding") or "").lower().replace("x-", "")
+		if decompress and encoding in ("gzip", "deflate"):
+			self._body = DecompressingReader(raw, encoding)
+		else:
+			self._body = raw
+	
+	def info(self):
+		return self.headers
+	
+	def setDeadline(self, deadline):
+		"""Makes read() raise socket.timeout once time.time() passes deadline, even if the server keeps trickling data.
+		
+		The socket timeout only limits each wait for data, so this shuts the connection down from a timer thread."""
+		self._timer = threading.Timer(max(deadline - time.time(), 0), self._expire)
+		self._timer.setDaemon(True)
+		self._timer.start()
+	
+	def _expire(self):
+		self._lock.acquire()
+		try:
+			if self._conn is None:
+				return
+			self.expired = True
+			sock = self._conn.sock or getattr(self._raw.fp, "_sock", None) # httplib lets go of conn.sock if the server will close the connection
+			try:
+				sock.shutdown(socket.SHUT_RDWR) # Wakes up a read that's waiting on the server
+			except (socket.error, AttributeError):
+				pass
+		finally:
+			self._lock.release()
+	
+	def _readBody(self, size):
+		try:
+			data = self._body.read(size)
+		except (socket.error, httplib.HTTPException):
+			if self.expired:
+				raise socket.timeout("Response took too long")
+			raise
+		if self.expired:
+			raise socket.timeout("Response took too long")
+		return data
+	
+	def read(self, size = None):
+		if size is not None:
+			return self._readBody(size)
+		chunks = []
+		while True:
+			chunk = self._readBody(64*1024)
+			if not chunk:
+				return "".join(chunks)
+			chunks.append(chunk)
+	
+	def close(self):
+		if self._timer is not None:
+			self._timer.cancel()
+		self._lock.acquire()
+		try:
+			if self._conn is not None:
+				self._client._release(self._key, self._conn, self._raw) # Closes the connection rather than pooling it if the body wasn't all read
+				self._conn = None
+		finally:
+			self._lock.release()
+
+
+class HttpClient:
+	"""An HTTP client that keeps connections open between requests, for sharing between the feed and enclosure downloaders.
+	
+	Idle keep-alive connections are pooled per host, permanent redirects are remembered so that later requests go straight
+	to the new URL, and responses can be compressed in transit. Safe to use from several threads at once.
+	Raises socket.timeout if the server stalls, and IOError for other failures.
+	"""
+	
+	USER_AGENT = "Audrey/0.1"
+	MAX_IDLE_PER_HOST = 4 # Keep at most this many idle connections open to each host
+	IDLE_TIMEOUT = 30 # Close connections that have been idle for longer than this, in seconds
+	MAX_REDIRECTS = 5
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._idle = {} # Maps (scheme, host, port) to lists of (connection, time returned) tuples
+		self._redirects = {} # Maps URLs to the URLs they have permanently moved to
+	
+	def _acquire(self, key):
+		self._lock.acquire()
+		try:
+			conns = self._idle.get(key, [])
+			while len(conns) > 0:
+				(conn, returned) = conns.pop()
+				if time.time() - returned < self.IDLE_TIMEOUT:
+					return conn
+				conn.close()
+			return None
+		finally:
+			self._lock.release()
+	
+	def _release(self, key, conn, raw):
+		if not raw.isclosed() and raw.length == 0:
+			raw.read() # Lets httplib notice that a bodiless response is finished
+		if not raw.isclosed() or raw.will_close:
+			conn.close() # Body not fully read, or the server is closing the connection
+			return
+		self._lock.acquire()
+		try:
+			conns = self._idle.setdefault(key, [])
+			if len(conns) < self.MAX_IDLE_PER_HOST:
+				conns.append((conn, time.time()))
+				conn = None
+		finally:
+			self._lock.release()
+		if conn is not None:
+			conn.close()
+	
+	def _send(self, url, headers):
+		parts = urlparse.urlsplit(url)
+		if parts.scheme not in ("http", "https") or not parts.hostname:
+			raise IOError("Unsupported URL %s" % url)
+		key = (parts.scheme, parts.hostname, parts.port)
+		path = parts.path or "/"
+		if parts.query:
+			path += "?" + parts.query
+		headers = dict(headers)
+		if parts.username is not None:
+			headers["Authorization"] = "Basic %s" % base64.b64encode("%s:%s" % (parts.username, parts.password or ""))
+		
+		conn = self._acquire(key)
+		while True:
+			reused = conn is not None
+			if conn is None:
+				if parts.scheme == "https":
+					conn = httplib.HTTPSConnection(parts.hostname, parts.port)
+				else:
+					conn = httplib.HTTPConnection(parts.hostname, parts.port)
+			try:
+				conn.request("GET", path, headers = headers)
+				return (key, conn, conn.getresponse())
+			except socket.timeout:
+				conn.close()
+				raise
+			except (httplib.HTTPException, socket.error), e:
+				conn.close()
+				if not reused:
+					raise IOError("Request for %s failed : %s" % (url, str(e)))
+				conn = None # The server probably closed the idle connection; try again with a new one
+	
+	def request(self, url, headers = None, compress = False):
+		"""Makes a GET request and returns an HttpResponse, following any redirects.
+		
+		headers is a dictionary of extra request headers. If compress is True the server may compress the response,
+		which is transparently decompressed; don't use this with Range requests."""
+		headers = dict(headers or {})
+		headers.setdefault("User-Agent", self.USER_AGENT)
+		headers["Accept-Encoding"] = compress and "gzip, deflate" or "identity"
+		
+		permanentUrl = None
+		self._lock.acquire()
+		try:
+			for n in range(self.MAX_REDIRECTS):
+				if url not in self._redirects:
+					break
+				url = permanentUrl = self._redirects[url]
+		finally:
+			self._lock.release()
+		
+		permanent = True # Whether every redirect so far has been a permanent one
+		for n in range(self.MAX_REDIRECTS + 1):
+			(key, conn, raw) = self._send(url, headers)
+			if raw.status not in (301, 302, 303, 307, 308) or not raw.getheader("Location"):
+				return HttpResponse(self, key, conn, raw, url, permanentUrl, compress)
+			location = urlparse.urljoin(url, raw.getheader("Location"))
+			raw.read()
+			self._release(key, conn, raw)
+			if permanent and raw.status in (301, 308):
+				self._lock.acquire()
+				try:
+					self._redirects[url] = location
+				finally:
+					self._lock.release()
+				permanentUrl = location
+			else:
+				permanent = False
+			url = location
+		raise IOError("Too many redirects for %s" % url)
+
+
+_sharedHttpClient = None
+_sharedHttpClientLock = threading.Lock()
+
+def sharedHttpClient():
+	"""Returns the HttpClient shared by everything in this process."""
+	global _sharedHttpClient
+	_sharedHttpClientLock.acquire()
+	try:
+		if _sharedHttpClient is None:
+			_sharedHttpClient = HttpClient()
+		return _sharedHttpClient
+	finally:
+		_sharedHttpClientLock.release()
+
+
+class StreamingFeedReader:
+	"""Reads an RSS 2.0 or Atom 1.0 feed incrementally, stopping once it gets to entries that have already been seen.
+	
+	Archive feeds can carry their entire history in every response, newest entries first. Rather than parsing the whole
+	document, this reads entries one at a time and stops after STOP_AFTER_OLD old entries in a row, so that
+	the time and memory needed scale with the number of new entries. Feeds whose entries aren't newest-first are read
+	to the end, but still only the new entries and the keepOld most recent old ones are held in memory.
+	
+	isOld is called with each entry and should return True if it has already been seen.
+	
+	read() returns a feedparser-style result with the feed.title and entries keys, where each entry may have title, id,
+	date_parsed and enclosures keys, and each enclosure has href and length keys. It raises SyntaxError if the feed is malformed or isn't in
+	one of the formats understood here; feedparser should be used for those instead.
+	"""
+	
+	STOP_AFTER_OLD = 3 # Stop reading after this many old entries in a row
+	ATOM = "{http://www.w3.org/2005/Atom}"
+	DC = "{http://purl.org/dc/elements/1.1/}"
+	
+	def __init__(self, isOld, keepOld):
+		self._isOld = isOld
+		self._keepOld = keepOld
+		self.entriesRead = 0
+		self.stoppedEarly = False
+	
+	def _text(self, elem):
+		if elem is None:
+			return None
+		return "".join(elem.itertext()).strip()
+	
+	def _entry(self, elem, atom, baseUrl):
+		entry = feedparser.FeedParserDict()
+		if atom:
+			ns = self.ATOM
+			title = self._text(elem.find(ns + "title"))
+			guid = self._text(elem.find(ns + "id"))
+			dateStr = self._text(elem.find(ns + "updated")) or self._text(elem.find(ns + "published"))
+			enclosures = [(link.get("href"), link.get("length")) for link in elem.findall(ns + "link") if link.get("rel") == "enclosure"]
+		else:
+			title = self._text(elem.find("title"))
+			guid = self._text(elem.find("guid"))
+			dateStr = self._text(elem.find("pubDate")) or self._text(elem.find(self.DC + "date"))
+			enclosures = [(enc.get("url"), enc.get("length")) for enc in elem.findall("enclosure")]
+		if title is not None:
+			entry["title"] = title
+		if guid:
+			entry["id"] = urlparse.urljoin(baseUrl, guid) # feedparser resolves ids against the feed's url too
+		if dateStr:
+			dateParsed = feedparser._parse_date(dateStr)
+			if dateParsed is not None:
+				entry["date_parsed"] = dateParsed
+		entry["enclosures"] = [feedparser.FeedParserDict(href = urlparse.urljoin(baseUrl, href), length = length or "") for (href, length) in enclosures if href]
+		return entry
+	
+	def read(self, fh, baseUrl):
+		"""Reads a feed from the file-like object fh. baseUrl is the URL it came from, for resolving relative links."""
+		d = feedparser.FeedParserDict()
+		d["feed"] = feedparser.FeedParserDict(title = "")
+		d["entries"] = []
+		
+		newEntries = []
+		oldEntries = [] # Heap of (time, n, entry) for the most recent old entries
+		oldInARow = 0
+		newestFirst = True
+		lastTime = None
+		depth = 0
+		root = None
+		container = None # The element whose children are the entries
+		atom = False
+		for (event, elem) in etree.iterparse(fh, ("start", "end")):
+			if event == "start":
+				depth += 1
+				if depth == 1:
+					root = elem
+					atom = (elem.tag == self.ATOM + "feed")
+					if atom:
+						container = elem
+					elif elem.tag != "rss":
+						raise SyntaxError("Unsupported feed type %s" % elem.tag)
+				elif depth == 2 and not atom and elem.tag == "channel":
+					container = elem
+				continue
+			
+			depth -= 1
+			if container is None:
+				continue
+			if elem.tag == (atom and self.ATOM + "title" or "title") and depth == (atom and 1 or 2):
+				d.feed["title"] = self._text(elem)
+			elif elem.tag == (atom and self.ATOM + "entry" or "item") and depth == (atom and 1 or 2):
+				entry = self._entry(elem, atom, baseUrl)
+				container.clear() # The entry has been copied out, so free it and any before it
+				self.entriesRead += 1
+				if "date_parsed" not in entry or len(entry.enclosures) == 0:
+					continue
+				etime = time.mktime(entry.date_parsed)
+				if lastTime is not None and etime > lastTime:
+					newestFirst = False
+				lastTime = etime
+				if self._isOld(entry):
+					oldInARow += 1
+					heapq.heappush(oldEntries, (etime, self.entriesRead, entry))
+					if len(oldEntries) > self._keepOld:
+						heapq.heappop(oldEntries)
+					if newestFirst and oldInARow >= self.STOP_AFTER_OLD and len(oldEntries) >= self._keepOld:
+						self.stoppedEarly = True
+						break
+				else:
+					oldInARow = 0
+					newEntries.append(entry)
+		
+		if root is None:
+			raise SyntaxError("Empty feed document")
+		d["entries"] = newEntries + [entry for (etime, n, entry) in oldEntries]
+		return d
+
+
 class FeedchkProcess(AudreyProcess):
 	"""An AudreyProcess for checking RSS/Atom feeds with the feedparser module and finding new podcasts to be downloaded.
 	
 	Reads the following working files:
-	feedchk-url-* - Files containing a url to an RSS/Atom feed. These are not deleted.
+	feedchk-url-* - Files containing a url to an RSS/Atom feed, and optionally a second line with the feed's download priority (a number, higher
+	  is sooner, default 0). These are not deleted.
 	
 	Writes the following working files:
 	feedchk-status-* - Text files each describing how up-to-date we are on feeds, corresponding to feedchk-url-* files.
 	fetch-desc-* - Read by the fetch process.
+	httpcache-* - An HttpCache of the ETag and Last-Modified validators for each feed.
+	
+	Entries the StateStore has already seen, by GUID or enclosure URL, are skipped even if their date looks new.
+	Each feed is checked on its own schedule, worked out by a FeedScheduler from the dates of the feed's recent entries.
+	RSS 2.0 and Atom 1.0 feeds are read with a StreamingFeedReader, which stops at the first entries already seen; other
+	and malformed feeds are parsed in full by feedparser.
 	"""
 	
+	MAX_CONCURRENT = 8 # Check at most this many feeds at once
+	MAX_PER_HOST = 2 # Check at most this many feeds from the same host at once
+	FEED_TIMEOUT = 60 # Give up on a feed if its server stalls for this many seconds
+	FEED_DEADLINE = 5*60 # Give up on a feed if reading it takes longer than this many seconds altogether
+	RESCAN_INTERVAL = 60 # Look for added or removed feedchk-url-* files this often, in seconds
+	RECENT_ENTRIES = 10 # Remember the dates of this many recent entries per feed for working out its publishing cadence
+	STREAM_PARSE = True # Read feeds incrementally with a StreamingFeedReader where possible
+	TEMP_PREFIXES = ("temp-feedchk-", "temp-fetch-desc-", "temp-httpcache-")
+	
 	def __init__(self, workingDir):
 		super(FeedchkProcess, self).__init__(workingDir)
+		self._http = sharedHttpClient()
+		self._httpCache = HttpCache(workingDir)
 	
 	def _checkFeed(self, fn):
 		self.logMsg("Reading feed url file %s" % fn)
@@ -70,55 +1597,57 @@ class FeedchkProcess(AudreyProcess):
 		statusPath = os.path.join(self.workingDir, fn.replace("-url-", "-status-", 1))
 		
 		fh = open(os.path.join(self.workingDir, fn))
-		url = fh.read().strip()
+		urlLines = [line.strip() for line in fh.readlines()]
 		fh.close()
+		url = urlLines[0]
+		priority = self._feedPriority(urlLines)
 		
-		http_etag = None
-		http_modified = None
 		last_entry_date = None
+		entry_times = [] # Timestamps of the feed's most recent entries
 		
 		if os.path.exists(statusPath):
 			fh = open(statusPath)
-			etag_line = fh.readline().strip()
-			if etag_line != "None":
-				http_etag = etag_line # E-Tags are just strings for universal feed parser
-			modified_line = fh.readline().strip()
-			if modified_line != "None":
-				http_modified = tuple([int(x) for x in modified_line.split(",")]) # Modified headers are tuples of integers for universal feed parser
-			last_entry_line = fh.readline().strip()
-			if last_entry_line != "None":
-				last_entry_date = datetime.datetime(*tuple([int(x) for x in last_entry_line.split(",")]))
+			lines = [line.strip() for line in fh.readlines()]
 			fh.close()
+			if len(lines) >= 3:
+				# Status files from before the HttpCache start with ETag and Last-Modified lines
+				self._migrateValidators(url, lines[0], lines[1])
+				lines = lines[2:]
+			if len(lines) > 0 and lines[0] != "None":
+				last_entry_date = datetime.datetime(*tuple([int(x) for x in lines[0].split(",")]))
+			if len(lines) > 1 and lines[1] not in ("", "None"):
+				entry_times = [int(x) for x in lines[1].split(",")]
+		
+		def isOld(entry):
+			if last_entry_date is None or datetime.datetime.fromtimestamp(time.mktime(entry.date_parsed)) <= last_entry_date:
+				return True
+			return self.store is not None and self.store.hasSeen(entry.get("id") or entry.enclosures[0].href, entry.enclosures[0].href)
 		
+		deadline = time.time() + self.FEED_DEADLINE
 		try:
-			d = feedparser.parse(
-				url,
-				etag = http_etag,
-				modified = http_modified,
-				agent = "Audrey/0.1"
-			)
+			resp = self._http.request(url, self._httpCache.conditionalHeaders(url), compress = self.STREAM_PARSE)
 		except socket.timeout:
 			raise IOError("Timed out when retrieving feed at url \"%s\"" % url)
+		resp.setDeadline(deadline)
+		try:
+			if resp.permanentUrl is not None:
+				self.logMsg("Writing to %s, feed has permanently moved to url %s" % (fn, resp.permanentUrl))
+				self.writeWorkingFile(fn, [resp.permanentUrl] + urlLines[1:])
+				self._httpCache.forget(url)
+				url = resp.permanentUrl
+			
+			if resp.status // 100 == 4 or resp.status // 100 == 5:
+				raise IOError("Got error status code %u when retrieving feed at url \"%s\"" % (resp.status, url))
+			
+			if resp.status == 304:
+				self.metrics.count("feed_not_modified_total")
+				d = feedparser.FeedParserDict(feed = feedparser.FeedParserDict(title = ""), entries = [])
+			else:
+				d = self._parseFeed(resp, url, isOld, deadline)
+		finally:
+			resp.close()
 		
-		if "status" not in d:
-			raise IOError("Unable to retrieve feed at url \"%s\"" % url)
-		
-		if d.status // 100 == 4 or d.status // 100 == 5:
-			raise IOError("Got error status code %u when retrieving feed at url \"%s\"" % (d.status, url))
-		
-		if "etag" in d:
-			http_etag = d.etag
-		
-		if "modified" in d:
-			http_modified = d.modified
-		
-		if "status" in d and d.status == 301 and "href" in d:
-			self.logMsg("Writing to %s, status code 301 requesting we switch to url %s" % (fn, d.href))
-			fh = open(os.path.join(self.workingDir, fn), "w")
-			fh.write("%s\n" % d.href)
-			fh.close()
-		
-		files = [] # A list of (edate, url, title) tuples
+		files = [] # A list of (edate, url, title, key, length) tuples
 	
 		cleanPat = re.compile(r"[^A-Za-z0-9 #()._-]")
 		def cleanStr(s, maxLen):
@@ -129,7 +1658,9 @@ class FeedchkProcess(AudreyProcess):
 			if "date_parsed" not in entry or "title" not in entry or "enclosures" not in entry or len(entry.enclosures) < 1:
 				self.logMsg("Skipping weird entry")
 				continue
-			edate = datetime.datetime.fromtimestamp(time.mktime(entry.date_parsed))
+			etime = time.mktime(entry.date_parsed)
+			entry_times.append(int(etime))
+			edate = datetime.datetime.fromtimestamp(etime)
 			if newest_entry is None or edate > newest_entry:
 				newest_entry = edate
 			if last_entry_date is not None and edate > last_entry_date:
@@ -142,9 +1673,17 @@ class FeedchkProcess(AudreyProcess):
 					cleanStr(d.feed.title, 16),
 					cleanStr(entry.title, 15),
 				)
-				files.append((edate, entry.enclosures[0].href, fTitle))
+				itemKey = entry.get("id") or entry.enclosures[0].href
+				if self.store is not None and self.store.hasSeen(itemKey, entry.enclosures[0].href):
+					self.logMsg("Skipping already seen entry %s" % itemKey)
+					continue
+				length = entry.enclosures[0].get("length")
+				if not (length and length.isdigit() and int(length) > 0):
+					length = None # Plenty of feeds leave it out or put 0
+				files.append((edate, entry.enclosures[0].href, fTitle, itemKey, length))
 		if newest_entry is not None:
 			last_entry_date = newest_entry
+		entry_times = sorted(set(entry_times))[-self.RECENT_ENTRIES:]
 		
 		if len(files) > 0:
 			self.logMsg("Got %u seeming to be new" % len(files))
@@ -152,84 +1691,246 @@ class FeedchkProcess(AudreyProcess):
 		# Pick only the 3 most recent podcasts retrieved (in case of a mishap where the archives are mistakenly presented by the source as new again)
 		files.sort(cmp = lambda x, y: cmp(x[0], y[0]))
 		n = 0
-		for (file_date, file_url, file_title) in files[-3:]:
+		for (file_date, file_url, file_title, file_key, file_length) in files[-3:]:
 			n += 1
 			targetFn = "fetch-desc-%s-%s-%03u" % (fn.replace("feedchk-url-", ""), str(datetime.datetime.now()).replace(" ", "-"), n)
-			fh = open(os.path.join(self.workingDir, "temp-%s" % targetFn), "w")
-			fh.write("%s\n" % file_url)
-			fh.write("%s\n" % file_title)
-			fh.close()
-			os.rename(os.path.join(self.workingDir, "temp-%s" % targetFn), os.path.join(self.workingDir, targetFn)) # Give control to FetchProcess
+			self.writeWorkingFile(targetFn, [file_url, file_title, file_key, int(time.mktime(file_date.timetuple())), priority, file_length]) # Give control to FetchProcess
+			if self.store is not None:
+				self.store.addItem(file_key, fn, file_url, file_title, time.mktime(file_date.timetuple()), targetFn)
 			self.logMsg("Wrote %s" % targetFn)
 		
-		fh = open(statusPath, "w")
-		if http_etag is not None:
-			fh.write("%s\n" % http_etag)
-		else:
-			fh.write("None\n")
-		if http_modified is not None:
-			fh.write("%s\n" % (",".join(str(i) for i in http_modified)))
-		else:
-			fh.write("None\n")
+		statusLines = []
 		if last_entry_date is not None:
-			fh.write("%i,%i,%i,%i,%i,%i\n" % (
+			statusLines.append("%i,%i,%i,%i,%i,%i" % (
 				last_entry_date.year, last_entry_date.month, last_entry_date.day,
 				last_entry_date.hour, last_entry_date.minute, last_entry_date.second,
 			))
 		else:
-			fh.write("None\n")
-		fh.close()
+			statusLines.append("None")
+		if len(entry_times) > 0:
+			statusLines.append(",".join(str(t) for t in entry_times))
+		else:
+			statusLines.append("None")
+		self.writeWorkingFile(os.path.basename(statusPath), statusLines)
+		if self.store is not None:
+			self.store.feedChecked(fn, url, entry_times and entry_times[-1] or None)
+		if resp.status != 304:
+			# Only now that the new entries are safely written out is it okay to skip this version of the feed next time
+			self._httpCache.store(url, resp.headers.getheader("ETag"), resp.headers.getheader("Last-Modified"))
+		
+		return (len(files) > 0, entry_times)
+	
+	def _parseFeed(self, resp, url, isOld, deadline):
+		"""Parses the feed in an HttpResponse, returning a feedparser-style result. isOld is as for StreamingFeedReader.
+		
+		Raises IOError if the feed can't be read by deadline."""
+		try:
+			if self.STREAM_PARSE:
+				reader = StreamingFeedReader(isOld, self.RECENT_ENTRIES)
+				try:
+					d = reader.read(resp, resp.url)
+					self.metrics.count("feed_entries_parsed_total", reader.entriesRead)
+					if reader.stoppedEarly:
+						self.metrics.count("feed_early_stops_total")
+					return d
+				except (SyntaxError, zlib.error), e:
+					self.logMsg("Unable to stream feed at url \"%s\" (%s), parsing it in full" % (url, str(e)))
+					self.metrics.count("feed_full_parses_total")
+				# The streaming attempt used up the response, so get a fresh copy
+				resp = self._http.request(url)
+				resp.setDeadline(deadline)
+				if resp.status != 200:
+					resp.close()
+					raise IOError("Got status code %u when retrieving feed at url \"%s\" again" % (resp.status, url))
+			
+			d = feedparser.parse(resp) # Closes resp once it's read
+			if resp.expired: # feedparser keeps read errors to itself
+				raise socket.timeout()
+			return d
+		except socket.timeout:
+			raise IOError("Timed out when retrieving feed at url \"%s\"" % url)
+	
+	def _migrateValidators(self, url, etagLine, modifiedLine):
+		"""Moves the ETag and Last-Modified lines of an old-style feedchk-status-* file into the HttpCache."""
+		if self._httpCache.validators(url) != (None, None):
+			return
+		etag = None
+		if etagLine != "None":
+			etag = etagLine
+		modified = None
+		if modifiedLine != "None":
+			modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", tuple([int(x) for x in modifiedLine.split(",")]))
+		self._httpCache.store(url, etag, modified)
+	
+	def _feedUrl(self, fn):
+		"""Returns the url in the given feedchk-url-* file, or None if it can't be read."""
+		try:
+			fh = open(os.path.join(self.workingDir, fn))
+			try:
+				return fh.readline().strip()
+			finally:
+				fh.close()
+		except IOError:
+			return None
+	
+	def _feedPriority(self, urlLines):
+		"""Returns the priority from the lines of a feedchk-url-* file, or 0 if it has none."""
+		try:
+			return float(urlLines[1])
+		except (IndexError, ValueError):
+			return 0
+	
+	def _feedHost(self, fn):
+		"""Returns the host part of the url in the given feedchk-url-* file, or None if it can't be read."""
+		url = self._feedUrl(fn)
+		if url is None:
+			return None
+		return urlparse.urlparse(url)[1].lower()
+	
+	def _checkFeedSafely(self, fn):
+		foundNew = False
+		entryTimes = None
+		startTime = time.time()
+		try:
+			(foundNew, entryTimes) = self._checkFeed(fn)
+		except IOError, e:
+			self.logMsg("Error with %s - %s" % (fn, str(e)))
+			self.metrics.count("feed_errors_total")
+		self.metrics.count("feed_checks_total")
+		self.metrics.observe("feed_check_seconds", time.time() - startTime)
+		interval = self._scheduler.feedChecked(fn, entryTimes, foundNew)
+		self.logMsg("Next check of %s in %.1f hours" % (fn, interval/(60*60)))
+	
+	def _jobFailed(self, fn, tb):
+		self.logMsg("Uncaught exception checking %s! Traceback:\n%s" % (fn, tb))
+		self._scheduler.feedChecked(fn, None, False)
 	
 	def doStuff(self):
+		socket.setdefaulttimeout(self.FEED_TIMEOUT)
+		self._scheduler = FeedScheduler()
+		pool = self.makePool(self.MAX_CONCURRENT, self.MAX_PER_HOST, self._jobFailed)
+		self._httpCache.prune([self._feedUrl(fn) for fn in self.watcher.files("feedchk-url-")]) # Forget feeds that have been removed
+		nextScan = 0
 		while True:
 			self.pullEvent()
-			self.logMsg("Checking feeds")
-			for fn in sorted(os.listdir(self.workingDir)):
-				if fn.startswith("feedchk-url-"):
-					try:
-						self._checkFeed(fn)
-					except IOError, e:
-						self.logMsg("Error with %s - %s" % (fn, str(e)))
-			self.logMsg("Finished checking feeds")
-			time.sleep(3600)
+			
+			now = time.time()
+			if now >= nextScan:
+				feeds = self.watcher.files("feedchk-url-")
+				self.metrics.setGauge("feeds", len(feeds))
+				for fn in feeds:
+					self._scheduler.add(fn) # New feeds are due right away
+				for fn in self._scheduler.feeds():
+					if fn not in feeds:
+						self._scheduler.remove(fn)
+				nextScan = now + self.RESCAN_INTERVAL
+			
+			due = sorted(self._scheduler.popDue(now))
+			if len(due) > 0:
+				self.logMsg("Checking %u due feeds" % len(due))
+			for fn in due:
+				if not pool.submit(fn, self._feedHost(fn), self._checkFeedSafely, (fn,)):
+					self.logMsg("Still checking %s, skipping it" % fn) # It'll be rescheduled when the running check finishes
+			
+			wakeTime = nextScan
+			nextDue = self._scheduler.nextDueTime()
+			if nextDue is not None:
+				wakeTime = min(wakeTime, nextDue)
+			if self.waitForFiles(("feedchk-url-",), min(max(wakeTime - time.time(), 0.5), self.RESCAN_INTERVAL)):
+				nextScan = 0 # A feed was added or changed, so pick it up right away
 
 
 class FetchProcess(AudreyProcess):
 	"""An AudreyProcess for downloading files.
 	
 	Reads the following working files:
-	fetch-desc-* - Files each containing two lines: URL, title. Read in lexicographical order. Deleted once corresponding isobuild-item-* files are created.
+	fetch-desc-* - Files each containing up to six lines: URL, title, StateStore item key, entry time, feed priority, enclosure size in bytes (or None).
+	  Deleted once corresponding isobuild-item-* files are created.
 	
 	Writes the following working files:
 	isobuild-item-* - Read by the isobuild process.
+	transcode-item-* - Written instead of isobuild-item-* if TRANSCODE is set. Read by the transcode process.
+	fetch-partial-* - Partially downloaded enclosures, named by a hash of their URL. Renamed to isobuild-item-* when complete.
+	fetch-journal-* - Files each containing four lines describing a fetch-partial-* file: URL, ETag, Last-Modified, total length.
+	fetch-digests - A DigestIndex of every enclosure downloaded so far.
+	
+	If DEDUPLICATE is set, enclosures whose URL or content has been downloaded before are dropped rather than being
+	passed on to the isobuild process. Content is hashed while it downloads, so this costs no extra reads.
+	
+	Several downloads run at once and all of them together share one bandwidth limit. An interrupted download is kept
+	and resumed later with a Range request, as long as the server gave us an ETag or Last-Modified date to check it against.
+	Downloads go through the process's shared HttpClient, so connections to the same host are reused.
+	
+	Each download reserves its Content-Length in the SpaceBudget before it starts, always leaving SPACE_HEADROOM bytes
+	of the budget free so that there's room for the isobuild process to build an ISO and free the space up again.
+	Downloads whose advertised size doesn't fit are held back, and the budget is checked again every SPACE_RECHECK_INTERVAL.
+	
+	Queued downloads are started in order of feed priority first. Then come the ones which fit on the disc that the
+	isobuild process is currently filling, so that it reaches REQ_SIZE or TRIP_SIZE sooner. After that, older entries
+	go first, and among entries published on the same day, smaller enclosures go first.
 	"""
 	
+	MAX_TRANSFERS = 4 # Run at most this many downloads at once
+	MAX_PER_HOST = 2 # Run at most this many downloads from the same host at once
+	BANDWIDTH_LIMIT = None # Total download rate limit in bytes per second, or None for unlimited
+	RATE_WINDOWS = [] # A list of (start hour, end hour, bytes per second) tuples which override BANDWIDTH_LIMIT at those times of day, e.g. (9, 17, 64*1024)
+	CHUNK_SIZE = 64*1024 # Read downloads in chunks of this many bytes
+	RESCAN_INTERVAL = 60 # Recheck fetch-desc-* files for retries and bandwidth windows this often, in seconds
+	RETRY_DELAY = 600 # Wait this many seconds before retrying a failed download
+	DEDUPLICATE = True # Drop enclosures whose URL or content has already been downloaded
+	TRANSCODE = False # Pass downloads through a TranscodeProcess on their way to the isobuild process
+	TEMP_PREFIXES = ("temp-fetch-journal-",)
+	SPACE_HEADROOM = 700*1024*1024 # Pause downloading while less than this many bytes of the SpaceBudget are left
+	UNKNOWN_SIZE = 64*1024*1024 # Reserve this many bytes for downloads whose size isn't known in advance
+	SPACE_RECHECK_INTERVAL = 10 # While paused for space, check the budget again this often, in seconds
+	
 	def __init__(self, workingDir):
 		super(FetchProcess, self).__init__(workingDir)
+		self._bucket = TokenBucket()
+		self._digests = DigestIndex(os.path.join(workingDir, "fetch-digests"))
+		self._retryTimes = {} # Maps URLs whose download failed to the time they may be retried
+		self._http = sharedHttpClient()
 	
 	def _fetch(self, fn):
 		self.logMsg("Reading fetch description file %s" % fn)
 		
-		fh = open(os.path.join(self.workingDir, fn))
-		url = fh.readline().strip()
-		title = fh.readline().strip()
-		fh.close()
+		desc = self._readDesc(fn)
+		if desc is None:
+			raise IOError("Unable to read %s" % fn)
+		(url, title, itemKey) = desc[:3]
+		
+		if self.DEDUPLICATE and self._digests.hasUrl(url):
+			self._dropDuplicate(fn, itemKey, "URL %s has been downloaded before" % url)
+			return
 		
-		destPath = os.path.join(self.workingDir, "temp-fetch")
+		key = hashlib.sha1(url).hexdigest()
+		destPath = os.path.join(self.workingDir, "fetch-partial-%s" % key)
+		journalFn = "fetch-journal-%s" % key
+		self.logMsg("Fetching URL %s" % url)
+		startTime = time.time()
 		try:
-			self.logMsg("Fetching URL %s" % url)
-			try:
-				(retrFn, retrHeaders) = urllib.urlretrieve(url, destPath)
-			except socket.timeout:
-				raise IOError("Timed out when fetching URL %s" % url)
-			self.logMsg("Done fetching URL %s" % url)
-		except:
-			if os.path.isfile(destPath):
-				os.unlink(destPath)
-			raise
+			(size, downloaded, digest) = self._download(url, destPath, journalFn)
+		except socket.timeout:
+			raise IOError("Timed out when fetching URL %s" % url)
+		elapsed = max(time.time() - startTime, 0.001)
+		self.logMsg("Done fetching URL %s, %.1f MB of %.1f MB at %.1f KB/s" % (
+			url,
+			downloaded/(1024*1024),
+			size/(1024*1024),
+			downloaded/1024/elapsed,
+		))
+		self.metrics.count("download_bytes_total", downloaded)
+		self.metrics.observe("download_seconds", elapsed)
+		self.metrics.setGauge("download_bytes_per_second", downloaded/elapsed)
 		
 		if not os.path.exists(destPath):
-			raise IOError("Cannot find temp-fetch")
+			raise IOError("Cannot find %s" % os.path.basename(destPath))
+		
+		if self.DEDUPLICATE and self._digests.hasDigest(digest):
+			self._discardPartial(destPath, journalFn)
+			self._digests.add(digest, url) # So that this URL is never downloaded again
+			self._dropDuplicate(fn, itemKey, "content of %s has been downloaded before" % url)
+			return
 		
 		finalName = title
 		for knownExt in (".ogg", ".mp3", ".mp4", ".m4a", ".wma", ".flc", ".flac"):
@@ -237,27 +1938,596 @@ class FetchProcess(AudreyProcess):
 				finalName += knownExt
 				break
 		
-		targetFn = "isobuild-item-%s" % finalName
-		n = 0
-		while os.path.exists(os.path.join(self.workingDir, targetFn)):
-			n += 1
-			targetFn = "isobuild-item-%s %03u" % (finalName, n)
-		os.rename(os.path.join(self.workingDir, "temp-fetch"), os.path.join(self.workingDir, targetFn))
-		self.logMsg("Wrote %s" % targetFn)
+		stage = (self.TRANSCODE and "transcode") or "isobuild"
+		targetFn = "%s-item-%s" % (stage, finalName)
+		n = 0
+		while os.path.exists(os.path.join(self.workingDir, targetFn)):
+			n += 1
+			targetFn = "%s-item-%s %03u" % (stage, finalName, n)
+		os.rename(destPath, os.path.join(self.workingDir, targetFn))
+		os.unlink(os.path.join(self.workingDir, journalFn))
+		self._digests.add(digest, url)
+		if self.store is not None:
+			self.store.setStage(itemKey, stage, targetFn, url)
+		self.logMsg("Wrote %s" % targetFn)
+		
+		os.unlink(os.path.join(self.workingDir, fn))
+		self.logMsg("Deleted %s" % fn)
+	
+	def _dropDuplicate(self, fn, itemKey, reason):
+		self.logMsg("Dropping %s, %s" % (fn, reason))
+		self.metrics.count("duplicates_dropped_total")
+		if self.store is not None:
+			self.store.setStage(itemKey, "dropped", None)
+		os.unlink(os.path.join(self.workingDir, fn))
+	
+	def _hashFile(self, path):
+		"""Returns a sha1 object fed with the contents of the given file."""
+		hasher = hashlib.sha1()
+		fh = open(path, "rb")
+		try:
+			while True:
+				chunk = fh.read(self.CHUNK_SIZE)
+				if not chunk:
+					break
+				hasher.update(chunk)
+		finally:
+			fh.close()
+		return hasher
+	
+	def _readJournal(self, journalFn):
+		"""Returns the (url, etag, modified, length) tuple from a fetch-journal-* file, or None if there is no such file."""
+		try:
+			fh = open(os.path.join(self.workingDir, journalFn))
+		except IOError:
+			return None
+		try:
+			lines = [line.strip() for line in fh.readlines()]
+		finally:
+			fh.close()
+		if len(lines) < 4:
+			return None
+		(url, etag, modified, length) = [(x != "None" and x) or None for x in lines[:4]]
+		if length is not None:
+			length = int(length)
+		return (url, etag, modified, length)
+	
+	def _discardPartial(self, destPath, journalFn):
+		for path in (destPath, os.path.join(self.workingDir, journalFn)):
+			if os.path.exists(path):
+				os.unlink(path)
+	
+	def _download(self, url, destPath, journalFn):
+		"""Downloads url to destPath within the bandwidth limit, resuming an earlier partial download if possible.
+		
+		Returns a (total size, bytes downloaded this time, SHA-1 hex digest of the whole file) tuple. Raises IOError if the download is incomplete; in that case
+		the partial file is kept for resuming later, unless the server gave no way of checking that it's still valid."""
+		journal = self._readJournal(journalFn)
+		offset = 0
+		if journal is not None and journal[0] == url and (journal[1] or journal[2]) and os.path.exists(destPath):
+			offset = os.path.getsize(destPath)
+		else:
+			journal = None
+			self._discardPartial(destPath, journalFn)
+		
+		headers = {}
+		if offset > 0:
+			self.logMsg("Resuming %s from byte %u" % (url, offset))
+			headers["Range"] = "bytes=%u-" % offset
+			headers["If-Range"] = journal[1] or journal[2] # Get the whole thing again if it has changed since
+		
+		src = self._http.request(url, headers)
+		if src.status // 100 != 2:
+			src.close()
+			if src.status == 416 and offset > 0 and offset == journal[3]:
+				return (offset, 0, self._hashFile(destPath).hexdigest()) # We already have all of it
+			if src.status == 416:
+				self._discardPartial(destPath, journalFn)
+			raise IOError("Got error status code %u when fetching URL %s" % (src.status, url))
+		
+		etag = None
+		modified = None
+		reservation = None
+		try:
+			headers = src.info()
+			etag = headers.getheader("ETag")
+			modified = headers.getheader("Last-Modified")
+			if src.status == 206 and offset > 0:
+				contentRange = headers.getheader("Content-Range") or ""
+				m = re.match(r"bytes (\d+)-\d+/(\d+|\*)", contentRange)
+				if m is None or int(m.group(1)) != offset or (etag is not None and journal[1] is not None and etag != journal[1]):
+					self._discardPartial(destPath, journalFn)
+					raise IOError("Server sent a mismatched range for %s, discarded the partial download" % url)
+				length = journal[3]
+				if m.group(2) != "*":
+					length = int(m.group(2))
+				mode = "ab"
+				hasher = self._hashFile(destPath)
+			else:
+				offset = 0
+				length = headers.getheader("Content-Length")
+				if length is not None:
+					length = int(length)
+				self.writeWorkingFile(journalFn, [url, etag, modified, length])
+				mode = "wb"
+				hasher = hashlib.sha1()
+			reservation = self.budget.reserve(length or self.UNKNOWN_SIZE, destPath, self.SPACE_HEADROOM) # The part already downloaded doesn't count
+			
+			downloaded = 0
+			fh = open(destPath, mode)
+			try:
+				while True:
+					if self._stopRequested:
+						raise StageStopped()
+					chunk = src.read(self.CHUNK_SIZE)
+					if not chunk:
+						break
+					self._bucket.consume(len(chunk))
+					fh.write(chunk)
+					hasher.update(chunk)
+					downloaded += len(chunk)
+			finally:
+				fh.close()
+		except:
+			if not (etag or modified) and os.path.exists(destPath):
+				self._discardPartial(destPath, journalFn) # Can't safely resume this later
+			raise
+		finally:
+			src.close()
+			if reservation is not None:
+				self.budget.release(reservation)
+		
+		size = offset + downloaded
+		if length is not None and size != length:
+			raise IOError("Got %u of %u bytes from %s, will resume later" % (size, length, url))
+		return (size, downloaded, hasher.hexdigest())
+	
+	def _cleanPartials(self):
+		"""Deletes partial downloads whose fetch-desc-* files are gone."""
+		wanted = set()
+		for fn in os.listdir(self.workingDir):
+			if fn.startswith("fetch-desc-"):
+				desc = self._readDesc(fn)
+				if desc is not None:
+					wanted.add(hashlib.sha1(desc[0]).hexdigest())
+		for fn in os.listdir(self.workingDir):
+			if fn.startswith("fetch-journal-") or fn.startswith("fetch-partial-"):
+				if fn.split("-", 2)[2] not in wanted:
+					self.logMsg("Deleting abandoned partial download file %s" % fn)
+					os.unlink(os.path.join(self.workingDir, fn))
+	
+	def _currentRate(self):
+		"""Returns the bandwidth limit that applies right now, in bytes per second, or None if unlimited."""
+		hour = time.localtime().tm_hour
+		for (startHour, endHour, rate) in self.RATE_WINDOWS:
+			if startHour <= endHour:
+				if startHour <= hour < endHour:
+					return rate
+			elif hour >= startHour or hour < endHour: # The window wraps around midnight
+				return rate
+		return self.BANDWIDTH_LIMIT
+	
+	def _readDesc(self, fn):
+		"""Returns the (url, title, item key, entry time, priority, size) tuple from a fetch-desc-* file, or None if it can't be read.
+		
+		Older descriptions have fewer lines. The missing item key defaults to the url, the priority to 0, and the entry time and size to None."""
+		try:
+			fh = open(os.path.join(self.workingDir, fn))
+			try:
+				lines = [line.strip() for line in fh.readlines()]
+			finally:
+				fh.close()
+		except IOError:
+			return None
+		lines += [""]*(6 - len(lines))
+		def number(s, default):
+			try:
+				return float(s)
+			except ValueError:
+				return default
+		return (lines[0], lines[1], lines[2] or lines[0], number(lines[3], None), number(lines[4], 0), number(lines[5], None))
+	
+	def _pendingMb(self):
+		"""Returns the total size in MB of the downloaded items waiting for the transcode and isobuild processes."""
+		total = 0
+		for fn in self.watcher.files("transcode-item-") + self.watcher.files("isobuild-item-"):
+			st = self.watcher.stat(fn)
+			if st is not None:
+				total += st[0]
+		return total/(1024*1024)
+	
+	def _score(self, desc, pendingMb, now):
+		"""Returns the priority of a download in the HostLimitedPool. Higher scores are started first."""
+		(url, title, itemKey, entryTime, priority, size) = desc
+		spaceLeft = IsobuildProcess.MAX_SIZE - pendingMb % IsobuildProcess.MAX_SIZE # Room left on the disc being filled
+		sizeMb = (size or 0)/(1024*1024)
+		fits = size is None or sizeMb <= spaceLeft
+		ageDays = 0
+		if entryTime is not None:
+			ageDays = int((now - entryTime)/(60*60*24))
+		return (priority, fits, ageDays, -sizeMb)
+	
+	def _fetchSafely(self, fn, url):
+		try:
+			self._fetch(fn)
+		except SpaceExhausted, e:
+			self.logMsg("Not enough space for %s, will try again once there is - %s" % (fn, str(e)))
+			self.metrics.count("space_waits_total")
+			self._retryTimes[url] = time.time() + self.SPACE_RECHECK_INTERVAL
+		except IOError, e:
+			self.logMsg("Error with %s - %s" % (fn, str(e)))
+			self._retryTimes[url] = time.time() + self.RETRY_DELAY
+	
+	def _jobFailed(self, url, tb):
+		self.logMsg("Uncaught exception fetching %s! Traceback:\n%s" % (url, tb))
+		self._retryTimes[url] = time.time() + self.RETRY_DELAY
+	
+	def doStuff(self):
+		self._cleanPartials()
+		pool = self.makePool(self.MAX_TRANSFERS, self.MAX_PER_HOST, self._jobFailed)
+		paused = False
+		while True:
+			self.pullEvent()
+			self._bucket.setRate(self._currentRate())
+			now = time.time()
+			descs = self.watcher.files("fetch-desc-")
+			self.metrics.setGauge("queue_depth", len(descs))
+			
+			available = self.budget.available()
+			self.metrics.setGauge("space_available_bytes", available)
+			self.metrics.setGauge("working_set_bytes", self.budget.usage())
+			if available < self.SPACE_HEADROOM:
+				if not paused:
+					self.logMsg("Pausing downloads, only %.1f MB of space left" % (max(available, 0)/(1024*1024)))
+					paused = True
+				self.metrics.setGauge("paused", 1)
+				self.waitForFiles(("fetch-desc-",), self.SPACE_RECHECK_INTERVAL)
+				continue
+			if paused:
+				self.logMsg("Resuming downloads, %.1f MB of space left" % (available/(1024*1024)))
+				paused = False
+			self.metrics.setGauge("paused", 0)
+			
+			pendingMb = self._pendingMb()
+			jobs = [] # A list of (score, fn, desc) tuples
+			wakeTime = now + self.RESCAN_INTERVAL
+			for fn in descs:
+				desc = self._readDesc(fn)
+				if desc is not None:
+					retryTime = self._retryTimes.get(desc[0], 0)
+					if retryTime <= now:
+						jobs.append((self._score(desc, pendingMb, now), fn, desc))
+					else:
+						wakeTime = min(wakeTime, retryTime)
+			jobs.sort(reverse = True)
+			
+			# Only queue as many downloads as there's room for. Running ones have reserved theirs already, but queued ones haven't yet
+			busy = set(pool.busyKeys())
+			queued = set(pool.pendingKeys())
+			room = available - self.SPACE_HEADROOM - sum([desc[5] or self.UNKNOWN_SIZE for (score, fn, desc) in jobs if desc[0] in queued])
+			held = 0
+			for (score, fn, desc) in jobs:
+				if desc[0] not in busy:
+					if (desc[5] or self.UNKNOWN_SIZE) > room:
+						held += 1
+						continue
+					room -= desc[5] or self.UNKNOWN_SIZE
+				# Jobs are keyed by URL, so that two descriptions of the same enclosure never download into the same partial file at once
+				pool.submit(desc[0], urlparse.urlparse(desc[0])[1].lower(), self._fetchSafely, (fn, desc[0]), score)
+			self.metrics.setGauge("downloads_held", held)
+			
+			# Space freed by burned discs doesn't show up as a new file, so check again soon if anything is waiting for it
+			if held > 0:
+				wakeTime = min(wakeTime, now + self.SPACE_RECHECK_INTERVAL)
+			self.waitForFiles(("fetch-desc-",), max(wakeTime - time.time(), 0))
+
+
+class TranscodeProcess(AudreyProcess):
+	"""An AudreyProcess for re-encoding downloaded audio at a lower bitrate, so that more of it fits on each disc.
+	
+	Reads the following working files:
+	transcode-item-* - Downloaded files, named as isobuild-item-* files would be. Deleted once re-encoded.
+	
+	Writes the following working files:
+	isobuild-item-* - The re-encoded files, or the originals if re-encoding fails or doesn't make them any smaller. Read by the isobuild process.
+	
+	Only run if FetchProcess.TRANSCODE is set. Files are re-encoded by ENCODER, one encoder process per core at a time.
+	Since the isobuild process only ever sees the re-encoded files, it plans discs with their final sizes.
+	The sizes before and after are recorded in the StateStore. Space for each re-encoded file is reserved in the
+	SpaceBudget first, and if there isn't enough the original is kept.
+	"""
+	
+	ENCODER = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", "%(input)s", "-vn", "-codec:a", "libmp3lame", "-b:a", "%(bitrate)uk", "%(output)s"] # Encoder command line
+	TARGET_BITRATE = 64 # Re-encode to this many kbps
+	TARGET_EXT = ".mp3" # Extension of the files written by ENCODER
+	SOURCE_EXTS = (".ogg", ".mp3", ".m4a", ".wma", ".flc", ".flac") # Only re-encode files with these extensions; others are passed through unchanged
+	WORKERS = None # Run this many encoders at once, or None for one per core
+	RESCAN_INTERVAL = 60 # Recheck transcode-item-* files this often, in seconds
+	TEMP_PREFIXES = ("temp-transcode-item-",)
+	
+	def __init__(self, workingDir):
+		super(TranscodeProcess, self).__init__(workingDir)
+	
+	def _sourceExt(self, fn):
+		"""Returns the extension of a transcode-item-* file if it's one of SOURCE_EXTS, or None. Ignores any " 001" style suffix added to avoid a name clash."""
+		m = re.search(r"(\.\w+)( \d{3})?$", fn)
+		if m is not None and m.group(1).lower() in self.SOURCE_EXTS:
+			return m.group(1)
+		return None
+	
+	def _targetName(self, name):
+		"""Returns an unused isobuild-item-* name for the given in-ISO name."""
+		targetFn = "isobuild-item-%s" % name
+		n = 0
+		while os.path.exists(os.path.join(self.workingDir, targetFn)):
+			n += 1
+			targetFn = "isobuild-item-%s %03u" % (name, n)
+		return targetFn
+	
+	def _encode(self, path, tempPath):
+		"""Runs the encoder on path, writing tempPath. Raises IOError if it fails."""
+		args = [arg % {"input": path, "output": tempPath, "bitrate": self.TARGET_BITRATE} for arg in self.ENCODER]
+		try:
+			p = self.startChild(
+				args,
+				stdin = subprocess.PIPE, # Closed straight away by communicate()
+				stdout = subprocess.PIPE,
+				stderr = subprocess.STDOUT,
+				close_fds = True
+			)
+		except OSError, e:
+			raise IOError("Unable to run %s - %s" % (args[0], str(e)))
+		output = p.communicate()[0]
+		if p.returncode != 0:
+			raise IOError("%s failed with status %d: %s" % (args[0], p.returncode, output.strip()))
+		if not os.path.exists(tempPath):
+			raise IOError("%s didn't write %s" % (args[0], os.path.basename(tempPath)))
+	
+	def _transcode(self, fn):
+		path = os.path.join(self.workingDir, fn)
+		try:
+			originalSize = os.path.getsize(path)
+		except OSError:
+			return # Already done by a job that finished after the item was listed
+		tempPath = os.path.join(self.workingDir, "temp-%s%s" % (fn, self.TARGET_EXT))
+		
+		name = fn[len("transcode-item-"):]
+		encoded = False
+		sourceExt = self._sourceExt(fn)
+		reservation = None
+		if sourceExt is not None:
+			try:
+				reservation = self.budget.reserve(originalSize, tempPath) # The re-encoded file shouldn't be any bigger than the original
+			except SpaceExhausted, e:
+				self.logMsg("Not enough space to re-encode %s, keeping the original - %s" % (fn, str(e)))
+		if reservation is not None:
+			self.logMsg("Re-encoding %s at %u kbps" % (fn, self.TARGET_BITRATE))
+			startTime = time.time()
+			try:
+				try:
+					self._encode(path, tempPath)
+					self.metrics.observe("transcode_seconds", time.time() - startTime)
+					self.budget.usage() # Both the original and the re-encoded file are on disk now, so record the high water mark
+					if os.path.getsize(tempPath) < originalSize:
+						encoded = True
+					else:
+						self.logMsg("Re-encoding didn't make %s any smaller, keeping the original" % fn)
+				except IOError, e:
+					if self._stopRequested:
+						raise StageStopped() # The encoder was killed, so leave the item for the restarted process
+					self.logMsg("Error re-encoding %s, keeping the original - %s" % (fn, str(e)))
+					self.metrics.count("transcode_failures_total")
+			finally:
+				if not encoded:
+					self.budget.release(reservation)
 		
-		os.unlink(os.path.join(self.workingDir, fn))
-		self.logMsg("Deleted %s" % fn)
+		if encoded:
+			targetFn = self._targetName(name[:name.rfind(sourceExt)] + self.TARGET_EXT)
+			try:
+				os.rename(tempPath, os.path.join(self.workingDir, targetFn))
+			finally:
+				self.budget.release(reservation)
+			os.unlink(path)
+		else:
+			targetFn = self._targetName(name)
+			os.rename(path, os.path.join(self.workingDir, targetFn))
+		if os.path.exists(tempPath):
+			os.unlink(tempPath)
+		
+		size = os.path.getsize(os.path.join(self.workingDir, targetFn))
+		self.metrics.count("transcode_bytes_in_total", originalSize)
+		self.metrics.count("transcode_bytes_out_total", size)
+		if self.store is not None:
+			self.store.moveFiles([fn], "isobuild", targetFn)
+			self.store.recordSizes(targetFn, originalSize, size)
+		self.logMsg("Wrote %s, %.1f MB down from %.1f MB" % (targetFn, size/(1024*1024), originalSize/(1024*1024)))
+	
+	def _jobFailed(self, fn, tb):
+		self.logMsg("Uncaught exception re-encoding %s! Traceback:\n%s" % (fn, tb))
 	
 	def doStuff(self):
+		workers = self.WORKERS or processing.cpuCount()
+		pool = self.makePool(workers, workers, self._jobFailed) # The encoders are the worker processes; each thread just waits on one
 		while True:
 			self.pullEvent()
-			for fn in sorted(os.listdir(self.workingDir)):
-				if fn.startswith("fetch-desc-"):
-					try:
-						self._fetch(fn)
-					except IOError, e:
-						self.logMsg("Error with %s - %s" % (fn, str(e)))
-			time.sleep(60)
+			self.watcher.refresh() # Our own renames of finished items may not have been seen yet
+			items = self.watcher.files("transcode-item-")
+			self.metrics.setGauge("queue_depth", len(items))
+			for fn in items:
+				pool.submit(fn, None, self._transcode, (fn,))
+			self.waitForFiles(("transcode-item-",), self.RESCAN_INTERVAL)
+
+
+class DiscPlanner:
+	"""Plans how to pack items onto a series of discs so that each disc comes out as full as possible.
+	
+	Discs are planned one at a time. The oldest item, and every other item older than mustAge days, goes onto the first
+	disc (oldest first, while they fit) so that nothing is left waiting forever. The rest of each disc is filled with the
+	subset of the remaining items that comes closest to filling it, found by dynamic programming over item sizes rounded
+	up to whole UNITs. Where there are too many items for that to be quick, first-fit-decreasing is used instead.
+	"""
+	
+	UNIT = 2048/(1024*1024) # Size granularity of the packing search, in MB; each file takes up whole 2048 byte sectors on the disc anyway
+	MAX_EXACT_ITEMS = 400 # Above this many items, fall back to first-fit-decreasing
+	
+	def __init__(self, maxSize, mustAge = None):
+		"""Creates a planner for discs holding less than maxSize MB of items each."""
+		self.maxSize = maxSize
+		self.mustAge = mustAge
+	
+	def plan(self, fileDescs, maxDiscs = None):
+		"""Plans up to maxDiscs discs from a list of (name, size in MB, age in days) tuples.
+		
+		Returns a list of (fileDescs, total size in MB) tuples, one per disc, first disc first. Items too big to fit
+		on any disc are left out, and planning stops early if the remaining items can't make up another disc."""
+		remaining = [f for f in fileDescs if f[1] < self.maxSize]
+		remaining.sort(cmp = lambda x, y: cmp(y[2], x[2])) # Oldest first
+		discs = []
+		while len(remaining) > 0 and (maxDiscs is None or len(discs) < maxDiscs):
+			disc = []
+			total = 0
+			if len(discs) == 0:
+				for f in remaining:
+					if f is remaining[0] or (self.mustAge is not None and f[2] > self.mustAge):
+						if total + f[1] < self.maxSize:
+							disc.append(f)
+							total += f[1]
+				remaining = [f for f in remaining if f not in disc]
+			for f in self._fill(remaining, self.maxSize - total):
+				disc.append(f)
+				total += f[1]
+			if len(disc) == 0:
+				break
+			remaining = [f for f in remaining if f not in disc]
+			discs.append((disc, total))
+		return discs
+	
+	def _fill(self, items, capacity):
+		"""Returns the subset of items whose total size comes closest to capacity without reaching it."""
+		if len(items) > self.MAX_EXACT_ITEMS:
+			return self._firstFitDecreasing(items, capacity)
+		
+		cells = int(math.ceil(capacity/self.UNIT)) - 1 # Stay strictly below capacity
+		if cells <= 0:
+			return []
+		units = [int(math.ceil(f[1]/self.UNIT)) for f in items]
+		mask = (1 << (cells + 1)) - 1
+		reachable = 1 # Bit c is set if some subset of the items seen so far adds up to exactly c units
+		history = [] # The value of reachable before each item was seen
+		for i in range(len(items)):
+			history.append(reachable)
+			reachable = (reachable | (reachable << units[i])) & mask
+			if reachable >> cells:
+				break # Can't do any better than completely full
+		
+		best = reachable.bit_length() - 1
+		chosen = []
+		for i in range(len(history) - 1, -1, -1):
+			if not (history[i] >> best) & 1: # The best total couldn't be reached without this item
+				chosen.append(items[i])
+				best -= units[i]
+		return chosen
+	
+	def _firstFitDecreasing(self, items, capacity):
+		chosen = []
+		total = 0
+		for f in sorted(items, cmp = lambda x, y: cmp(y[1], x[1])):
+			if total + f[1] < capacity:
+				chosen.append(f)
+				total += f[1]
+		return chosen
+
+
+class BlockDigests:
+	"""SHA-1 digests of each BLOCK_SIZE block of a disc image, for checking a burned disc against the image it was burned from.
+	
+	Build one up with update() and finish(), or from an image file with fromImage(). Saved as a working file whose first
+	line is "<block size> <image size>", followed by one hex digest per line.
+	"""
+	
+	BLOCK_SIZE = 2*1024*1024 # A multiple of the 2048 byte CD sector size, so that every read of the disc is aligned
+	
+	def __init__(self, blockSize = None):
+		self.blockSize = blockSize or self.BLOCK_SIZE
+		self.size = 0
+		self.digests = []
+		self._hasher = hashlib.sha1()
+		self._inBlock = 0 # Number of bytes fed to _hasher so far
+	
+	def update(self, data):
+		"""Adds the next piece of the image, which may be a string or a buffer."""
+		offset = 0
+		while offset < len(data):
+			n = min(len(data) - offset, self.blockSize - self._inBlock)
+			self._hasher.update(buffer(data, offset, n))
+			self._inBlock += n
+			offset += n
+			if self._inBlock == self.blockSize:
+				self.digests.append(self._hasher.hexdigest())
+				self._hasher = hashlib.sha1()
+				self._inBlock = 0
+		self.size += len(data)
+	
+	def finish(self):
+		"""Adds the digest of the last, short block, if there is one. Call once the whole image has been given to update()."""
+		if self._inBlock > 0:
+			self.digests.append(self._hasher.hexdigest())
+			self._hasher = hashlib.sha1()
+			self._inBlock = 0
+	
+	def fromImage(cls, path):
+		"""Returns the BlockDigests of an image file, reading it through mmap so that no copies are made."""
+		digests = cls()
+		fh = open(path, "rb")
+		try:
+			if os.fstat(fh.fileno()).st_size > 0:
+				m = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+				try:
+					digests.update(m)
+				finally:
+					m.close()
+		finally:
+			fh.close()
+		digests.finish()
+		return digests
+	fromImage = classmethod(fromImage)
+	
+	def lines(self):
+		"""Returns the lines of the working file to save these digests in."""
+		return ["%u %u" % (self.blockSize, self.size)] + self.digests
+	
+	def load(cls, path):
+		"""Returns the BlockDigests saved in the given working file."""
+		fh = open(path)
+		try:
+			lines = [line.strip() for line in fh.readlines()]
+		finally:
+			fh.close()
+		(blockSize, size) = [int(x) for x in lines[0].split()]
+		digests = cls(blockSize)
+		digests.size = size
+		digests.digests = lines[1:]
+		return digests
+	load = classmethod(load)
+	
+	def check(self, fd):
+		"""Reads the image back from the start of the file descriptor fd one block at a time, comparing each block as it goes.
+		
+		Raises IOError at the first block that doesn't match, or if fd ends before the image does."""
+		remaining = self.size
+		for i in range(len(self.digests)):
+			want = min(self.blockSize, remaining)
+			hasher = hashlib.sha1()
+			got = 0
+			while got < want:
+				data = os.read(fd, want - got)
+				if not data:
+					raise IOError("Disc ended after %u of %u bytes" % (self.size - remaining + got, self.size))
+				hasher.update(data)
+				got += len(data)
+			if hasher.hexdigest() != self.digests[i]:
+				raise IOError("Block %u of the disc doesn't match the image" % i)
+			remaining -= want
 
 
 class IsobuildProcess(AudreyProcess):
@@ -265,9 +2535,15 @@ class IsobuildProcess(AudreyProcess):
 	
 	Reads the following working files:
 	isobuild-item-* - Files containing actual content. The name of the file after "item-" will be the in-ISO name. Deleted once put into an ISO.
+	isobuild-stage-* - Path lists of discburn-item-* files which DiscburnProcess failed to burn on the fly. Deleted once built into an ISO.
 	
 	Writes the following working files:
 	discburn-iso-* - Read by the discburn process.
+	discburn-digests-* - BlockDigests of each discburn-iso-* file, named after it. Written before the ISO is handed over.
+	discburn-stream-* - Path lists of discs to be burned on the fly, if STREAM_BURN is set. Read by the discburn process.
+	discburn-item-* - Items renamed from isobuild-item-* once they have been put into a discburn-stream-* path list.
+	
+	Items are packed onto discs by a DiscPlanner, which plans PLAN_AHEAD discs at a time.
 	"""
 	
 	# If both REQ values are passed, or either TRIP value is passed, create an ISO
@@ -276,20 +2552,43 @@ class IsobuildProcess(AudreyProcess):
 	TRIP_DAYS = 14 # If oldest file is this many days old, build an ISO for sure
 	TRIP_SIZE = 550 # If we have this many MB of files to burn, build an ISO for sure
 	MAX_SIZE = 600 # Don't build an ISO with more than this many MB of files
+	PLAN_AHEAD = 3 # Plan the packing of this many discs at a time
+	STREAM_BURN = False # Let DiscburnProcess pipe genisoimage straight into wodim instead of building ISO files first
+	RESCAN_INTERVAL = 60 # Re-evaluate item ages this often even if no new items arrive, in seconds
+	TEMP_PREFIXES = ("temp-discburn-iso-", "temp-discburn-stream-", "temp-discburn-digests-")
+	ISO_OVERHEAD = 4*1024*1024 # Reserve this many bytes more than the items' total size when building an ISO, for the filesystem
 	
 	def __init__(self, workingDir):
 		super(IsobuildProcess, self).__init__(workingDir)
 	
-	def _makeIso(self, filenames):
+	def _isoName(self, fn):
+		"""Returns the in-ISO name for an isobuild-item-* or discburn-item-* file."""
+		return fn.split("-item-", 1)[1]
+	
+	def _makeIso(self, filenames, sourceFn = None):
+		"""Builds an ISO of the given item files and hands it to DiscburnProcess. sourceFn is the isobuild-stage-* file they came from, if any.
+		
+		Raises SpaceExhausted, leaving the items where they are, if the SpaceBudget has no room for the ISO."""
 		targetFn = "discburn-iso-%s.iso" % (str(datetime.datetime.now()).replace(" ", "-"))
+		isoSize = sum([os.path.getsize(os.path.join(self.workingDir, fn)) for fn in filenames]) + self.ISO_OVERHEAD
+		reservation = self.budget.reserve(isoSize, os.path.join(self.workingDir, "temp-%s" % targetFn))
+		try:
+			self._buildIso(targetFn, filenames, sourceFn)
+		finally:
+			self.budget.release(reservation)
+		return True
+	
+	def _buildIso(self, targetFn, filenames, sourceFn):
 		self.logMsg("Generating %s" % targetFn)
+		startTime = time.time()
 		
 		try:
-			proc = subprocess.Popen(
+			proc = self.startChild(
 				("genisoimage", "-l", "-r", "-J", "-graft-points", "-o", os.path.join(self.workingDir, "temp-%s" % targetFn), "-path-list", "-"),
 				stdin = subprocess.PIPE,
 				stdout = subprocess.PIPE,
-				stderr = subprocess.STDOUT
+				stderr = subprocess.STDOUT,
+				close_fds = True
 			)
 		except OSError, e:
 			raise IOError("Unable to run genisoimage : %s" % str(e))
@@ -300,72 +2599,160 @@ class IsobuildProcess(AudreyProcess):
 		for fn in filenames:
 			self.logMsg("Adding %s" % fn)
 			fullPath = os.path.join(self.workingDir, fn)
-			proc.stdin.write("%s=%s\n" % (fn[14:], fullPath))
+			proc.stdin.write("%s=%s\n" % (self._isoName(fn), fullPath))
 		(stdout, stderr) = proc.communicate()
+		self.metrics.observe("genisoimage_seconds", time.time() - startTime)
 		
 		if proc.returncode != 0:
 			raise IOError("Genisoimage reported an error! Return code %s, output %s" % (proc.returncode, stdout))
+		self.budget.usage() # Both the items and the ISO are on disk now, so record the high water mark
 		
-		# Looks like the ISO was created correctly, so let's rename the temp ISO and delete the input files
+		# Looks like the ISO was created correctly, so let's record its digests, rename the temp ISO and delete the input files
+		tempPath = os.path.join(self.workingDir, "temp-%s" % targetFn)
+		self.writeWorkingFile(targetFn.replace("discburn-iso-", "discburn-digests-", 1), BlockDigests.fromImage(tempPath).lines()) # Read straight back from the page cache
 		self.logMsg("Finished generating %s, handing ISO to DiscburnProcess and deleting input files" % targetFn)
 		os.rename(os.path.join(self.workingDir, "temp-%s" % targetFn), os.path.join(self.workingDir, targetFn)) # Give control to DiscburnProcess
+		if self.store is not None:
+			self.store.moveFiles((sourceFn is not None and [sourceFn]) or filenames, "discburn", targetFn)
 		for fn in filenames:
 			fullPath = os.path.join(self.workingDir, fn)
 			os.unlink(fullPath)
 		
 		self.logMsg("Generation of %s completed successfully" % targetFn)
+	
+	def _planStream(self, filenames):
+		"""Hands the given item files to DiscburnProcess as a discburn-stream-* path list, to be burned without building an ISO file."""
+		targetFn = "discburn-stream-%s" % (str(datetime.datetime.now()).replace(" ", "-"))
+		moved = []
+		for fn in filenames:
+			newFn = fn.replace("isobuild-item-", "discburn-item-", 1)
+			os.rename(os.path.join(self.workingDir, fn), os.path.join(self.workingDir, newFn))
+			moved.append(newFn)
+		self.writeWorkingFile(targetFn, ["%s=%s" % (self._isoName(fn), os.path.join(self.workingDir, fn)) for fn in moved]) # Give control to DiscburnProcess
+		if self.store is not None:
+			self.store.moveFiles(filenames, "discburn", targetFn)
+		self.logMsg("Wrote %s with %u items" % (targetFn, len(moved)))
+	
+	def _buildStaged(self, fn):
+		"""Builds an ISO from an isobuild-stage-* path list handed back by DiscburnProcess."""
+		path = os.path.join(self.workingDir, fn)
+		filenames = [os.path.basename(itemPath) for (name, itemPath) in readPathList(path)]
+		self.logMsg("Building %s as an ISO file" % fn)
+		self._makeIso(filenames, fn)
+		os.unlink(path)
+	
+	def _recoverOrphans(self):
+		"""Gives discburn-item-* files that no path list mentions back to the isobuild-item-* pool, e.g. after a crash in _planStream().
 		
-		return True
+		Also deletes discburn-digests-* files whose ISO never got handed over."""
+		for fn in self.watcher.files("discburn-digests-"):
+			if not os.path.exists(os.path.join(self.workingDir, fn.replace("discburn-digests-", "discburn-iso-", 1))):
+				self.logMsg("Deleting orphaned digests file %s" % fn)
+				os.unlink(os.path.join(self.workingDir, fn))
+		wanted = set()
+		for fn in self.watcher.files("discburn-stream-") + self.watcher.files("isobuild-stage-"):
+			wanted.update([os.path.basename(itemPath) for (name, itemPath) in readPathList(os.path.join(self.workingDir, fn))])
+		for fn in self.watcher.files("discburn-item-"):
+			if fn not in wanted:
+				self.logMsg("Recovering orphaned item %s" % fn)
+				os.rename(os.path.join(self.workingDir, fn), os.path.join(self.workingDir, fn.replace("discburn-item-", "isobuild-item-", 1)))
+	
+	def _shouldBuild(self, greatestAge, totalSize):
+		"""Returns True if a disc holding totalSize MB, whose oldest item is greatestAge days old, should be built now."""
+		return (greatestAge > self.REQ_DAYS and totalSize > self.REQ_SIZE) or greatestAge > self.TRIP_DAYS or totalSize > self.TRIP_SIZE
+	
+	def _planDiscs(self, fileDescs):
+		"""Returns the DiscPlanner's plan for the given (name, size, age) tuples."""
+		return DiscPlanner(self.MAX_SIZE, self.TRIP_DAYS).plan(fileDescs, self.PLAN_AHEAD)
+	
+	def _waitingItems(self, now):
+		"""Returns a (name, size in MB, age in days) tuple for each isobuild-item-* file, as of the time now."""
+		fileDescs = []
+		for fn in self.watcher.files("isobuild-item-"):
+			st = self.watcher.stat(fn)
+			if st is not None:
+				fileDescs.append((
+					fn,
+					st[0]/(1024*1024), # Size in megabytes
+					(now - st[1])/(60*60*24), # Age in days since fetch (not the RSS item date)
+				))
+		return fileDescs
+	
+	def _chooseDisc(self, fileDescs):
+		"""Decides whether to build a disc from the given (name, size, age) tuples of waiting items.
+		
+		Returns the plan from _planDiscs() if its first disc should be built now, or None if not. simulate.py calls this too."""
+		if len(fileDescs) == 0:
+			return None
+		discs = self._planDiscs(fileDescs)
+		if len(discs) > 0 and self._shouldBuild(max([f[2] for f in fileDescs]), discs[0][1]):
+			return discs
+		return None
 	
 	def doStuff(self):
+		self._recoverOrphans()
 		while True:
 			self.pullEvent()
 			
-			fileDescs = [
-				(
-					fn,
-					os.path.getsize(os.path.join(self.workingDir, fn))/(1024*1024), # Size in megabytes
-					(time.time() - os.path.getmtime(os.path.join(self.workingDir, fn)))/(60*60*24), # Age in days since fetch (not the RSS item date)
-				)
-				for fn in os.listdir(self.workingDir)
-				if fn.startswith("isobuild-item-")
-			]
+			for fn in self.watcher.files("isobuild-stage-"):
+				try:
+					self._buildStaged(fn)
+				except IOError, e:
+					self.logMsg("Error creating ISO from %s - %s" % (fn, str(e)))
 			
-			if len(fileDescs) > 0:
-				fileDescs.sort(cmp = lambda x, y: cmp(y[2], x[2]))
-				greatestAge = fileDescs[0][2]
-				toBurn = []
-				totalSize = 0
-				for (fn, size, mtime) in fileDescs:
-					if totalSize + size >= self.MAX_SIZE:
-						continue
-					toBurn.append(fn)
-					totalSize += size
-				if (greatestAge > self.REQ_DAYS and totalSize > self.REQ_SIZE) or greatestAge > self.TRIP_DAYS or totalSize > self.TRIP_SIZE:
-					self.logMsg("Going to create an ISO with %.3f MB of item data, oldest %.3f days old" % (totalSize, greatestAge))
-					try:
-						self._makeIso([f[0] for f in fileDescs])
-					except IOError, e:
-						self.logMsg("Error creating ISO - %s" % str(e))
+			fileDescs = self._waitingItems(time.time())
+			self.metrics.setGauge("queue_depth", len(fileDescs))
+			built = False
+			discs = self._chooseDisc(fileDescs)
+			if discs is not None:
+				(toBurn, totalSize) = discs[0]
+				self.logMsg("Going to create an ISO with %.3f MB of item data, oldest %.3f days old" % (totalSize, max([f[2] for f in fileDescs])))
+				self.logMsg("Projected disc fill: %s" % ", ".join(["%.1f%%" % (100*size/self.MAX_SIZE) for (items, size) in discs]))
+				self.metrics.setGauge("disc_fill_ratio", totalSize/self.MAX_SIZE)
+				self.metrics.count("discs_planned_total")
+				try:
+					if self.STREAM_BURN:
+						self._planStream([f[0] for f in toBurn])
+					else:
+						self._makeIso([f[0] for f in toBurn])
+					built = True
+				except IOError, e:
+					self.logMsg("Error creating ISO - %s" % str(e))
 			
-			time.sleep(1)
-
+			# Our own renames and deletions don't wake us up, so go straight round again while there may be another disc to build
+			if built:
+				self.watcher.refresh()
+			else:
+				self.waitForFiles(("isobuild-item-", "isobuild-stage-"), self.RESCAN_INTERVAL)
 
-class DiscburnProcess(AudreyProcess):
-	"""An AudreyProcess for burning ISO9660 images to disc, and also controlling the opening and closing of the tray.
 
-	Reads the following working files:
-	discburn-iso-* - Files containing ISO images to burn. Read in lexciographical order. Deleted once successfully burned.
+class MediaMonitor:
+	"""Keeps watch on the disc in a burner drive, so that it only needs probing with cd-info when something may have changed.
+	
+	This base class has no way of noticing changes, so it just reports one every POLL_INTERVAL seconds.
 	"""
 	
-	def __init__(self, workingDir):
-		super(DiscburnProcess, self).__init__(workingDir)
-		self.fed = None # Whether or not the user has told us that we have a blank CD. None if unknown.
+	POLL_INTERVAL = 30 # Assume the disc may have changed this often, in seconds
+	
+	def __init__(self, device):
+		self.device = device
+		self._lastPoll = time.time()
 	
-	def _checkCd(self):
+	def changed(self):
+		"""Returns True if the disc may have changed since the last call."""
+		if time.time() - self._lastPoll >= self.POLL_INTERVAL:
+			self._lastPoll = time.time()
+			return True
+		return False
+	
+	def ready(self):
+		"""Returns True if the drive has a closed tray and has finished loading any disc, False if not, or None if it can't tell."""
+		return None
+	
+	def probe(self):
 		"""Returns 0 if we seem to have a blank CD, 1 if we seem to have a non-blank disc, 2 if we seem to have no media."""
 		try:
-			proc = subprocess.Popen(("cd-info", "--no-device-info"), stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+			proc = subprocess.Popen(("cd-info", "--no-device-info", self.device), stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, close_fds = True)
 		except OSError, e:
 			raise IOError("Unable to run cd-info : %s" % str(e))
 		(stdout, stderr) = proc.communicate()
@@ -376,105 +2763,710 @@ class DiscburnProcess(AudreyProcess):
 			return 2
 		else:
 			return 1
+
+
+class IoctlMediaMonitor(MediaMonitor):
+	"""A MediaMonitor that asks the kernel's cdrom driver for the drive status, which is cheap enough to do every time changed() is called.
+	
+	The device is opened only for the moment of each check, so that it's never held open while the tray is ejected or wodim is burning.
+	Raises IOError when created if the device doesn't support the CDROM_DRIVE_STATUS ioctl.
+	"""
+	
+	CDROM_DRIVE_STATUS = 0x5326
+	CDSL_CURRENT = 0x7fffffff
+	CDS_TRAY_OPEN = 2
+	CDS_DRIVE_NOT_READY = 3
+	
+	def __init__(self, device):
+		MediaMonitor.__init__(self, device)
+		self._status = self._driveStatus()
+	
+	def _driveStatus(self):
+		try:
+			fd = os.open(self.device, os.O_RDONLY | os.O_NONBLOCK)
+			try:
+				return fcntl.ioctl(fd, self.CDROM_DRIVE_STATUS, self.CDSL_CURRENT)
+			finally:
+				os.close(fd)
+		except (OSError, IOError), e:
+			raise IOError("Unable to get the drive status of %s : %s" % (self.device, str(e)))
+	
+	def changed(self):
+		status = self._driveStatus()
+		if status != self._status:
+			self._status = status
+			return True
+		return False
+	
+	def ready(self):
+		return self._driveStatus() not in (self.CDS_TRAY_OPEN, self.CDS_DRIVE_NOT_READY)
+
+
+class FakeMediaMonitor(MediaMonitor):
+	"""A MediaMonitor for testing, which reads the disc state from a file named after the device in FAKE_DIR.
+	
+	The file contains "blank" or "full"; if it's missing or says anything else there's no disc. Changing the file counts as a change of disc.
+	"""
+	
+	FAKE_DIR = None # Directory of fake drive state files
+	
+	def __init__(self, device):
+		MediaMonitor.__init__(self, device)
+		self._path = os.path.join(self.FAKE_DIR, os.path.basename(device))
+		self._mtime = self._stat()
+	
+	def _stat(self):
+		try:
+			return os.stat(self._path).st_mtime
+		except OSError:
+			return None
+	
+	def changed(self):
+		mtime = self._stat()
+		if mtime != self._mtime:
+			self._mtime = mtime
+			return True
+		return False
+	
+	def ready(self):
+		return True
+	
+	def probe(self):
+		try:
+			fh = open(self._path)
+			try:
+				state = fh.read().strip()
+			finally:
+				fh.close()
+		except IOError:
+			state = None
+		return {"blank": 0, "full": 1}.get(state, 2)
+
+
+def openMediaMonitor(device, kind = "auto"):
+	"""Returns a MediaMonitor for device. kind is "ioctl", "poll", "fake", or "auto" to use ioctl if the device supports it and polling otherwise."""
+	if kind == "fake":
+		return FakeMediaMonitor(device)
+	if kind == "poll":
+		return MediaMonitor(device)
+	try:
+		return IoctlMediaMonitor(device)
+	except IOError:
+		if kind == "ioctl":
+			raise
+		return MediaMonitor(device)
+
+
+class BurnerDrive:
+	"""The state of one of the burner drives managed by a DiscburnProcess."""
+	
+	def __init__(self, device):
+		self.device = device
+		self.fed = None # Whether or not the user has told us that this drive has a blank CD. None if unknown.
+		self.status = "Checking disc..."
+		self.media = None # The result of the last MediaMonitor.probe(), or None if it needs probing
+		self.eatRequested = False # Set when the user clicks the 'Eat!' button, cleared once the drive has noticed
+		self.error = None # Traceback of an unexpected exception in the drive's thread
+
+
+class DiscburnProcess(AudreyProcess):
+	"""An AudreyProcess for burning ISO9660 images to disc, and also controlling the opening and closing of the trays.
+	
+	Each of the DRIVES is looked after by its own thread, which keeps track of whether it has a blank disc and takes the
+	next waiting image whenever it does, so several discs can be burned at once. Drive states are sent to the controller
+	as "drives" messages.
+	
+	Discs are only probed with cd-info when the drive's MediaMonitor reports a change, when the user clicks the 'Eat!'
+	button, or at startup. MEDIA_MONITOR picks the kind of monitor, as for openMediaMonitor().
+	
+	If VERIFY is set, each disc is read back from the drive after burning and checked against the BlockDigests of its image.
+	An ISO whose disc fails the check is kept and burned again on the next blank disc, up to MAX_BURN_ATTEMPTS times.
+	A drive's device may be a plain file, such as a loopback file, for testing.
+
+	Reads the following working files:
+	discburn-iso-* - Files containing ISO images to burn. Read in lexciographical order. Deleted once successfully burned.
+	discburn-digests-* - BlockDigests of discburn-iso-* files. Deleted along with their ISOs.
+	discburn-stream-* - Path lists of discburn-item-* files to burn on the fly, after any discburn-iso-* files. Deleted along with their items once burned.
+	
+	Writes the following working files:
+	isobuild-stage-* - discburn-stream-* files that couldn't be burned on the fly, handed back to the isobuild process.
+	discburn-failed-* - ISOs that failed verification MAX_BURN_ATTEMPTS times, kept so that the user can look into it.
+	"""
+	
+	STREAM_BUFFER_SIZE = 32*1024*1024 # Buffer this many bytes between genisoimage and wodim when burning on the fly
+	STREAM_CHUNK_SIZE = 256*1024 # Move data from genisoimage to wodim in chunks of this many bytes
+	UNDERRUN_TIMEOUT = 5 # Give up on an on-the-fly burn if wodim is kept waiting for data this many seconds
+	DRIVES = ["/dev/cdrw"] # Device paths of the burners to use
+	POLL_INTERVAL = 0.5 # Check idle drives for a disc and for new images this often, in seconds
+	MEDIA_MONITOR = "auto" # Kind of MediaMonitor to watch the drives with
+	LOAD_TIMEOUT = 10 # Wait at most this long for a drive to load a disc after retracting its tray, in seconds
+	VERIFY = True # Read each disc back after burning it and check it against its image
+	MAX_BURN_ATTEMPTS = 3 # Give up on an ISO after its disc has failed verification this many times
+	
+	def __init__(self, workingDir):
+		super(DiscburnProcess, self).__init__(workingDir)
+		self.drives = [BurnerDrive(device) for device in self.DRIVES]
+		self._jobLock = threading.Lock()
+		self._pending = [] # Images waiting to be burned that no drive has taken yet
+		self._claimed = set() # Images that a drive is burning
+		self._failedBurns = {} # Maps ISOs to the number of times their discs have failed verification
+		self._statusLock = threading.Lock()
+		self._lastStatus = None # The status message and drive states last sent to the controller
+		self._lastDrives = None
+	
+	def _ejectTray(self, device):
+		subprocess.call(("eject", device), close_fds = True)
+	
+	def _retractTray(self, device):
+		subprocess.call(("eject", "-t", device), close_fds = True)
+	
+	def _openDisc(self, device):
+		"""Opens a freshly burned disc for reading, reloading the tray if the drive won't read it straight away. Returns a file descriptor."""
+		try:
+			return os.open(device, os.O_RDONLY)
+		except OSError, e:
+			self.logMsg("Unable to read back %s (%s), reloading the tray" % (device, str(e)))
+		self._ejectTray(device)
+		self._retractTray(device)
+		deadline = time.time() + self.LOAD_TIMEOUT
+		while True:
+			try:
+				return os.open(device, os.O_RDONLY)
+			except OSError, e:
+				if time.time() >= deadline:
+					raise IOError("Unable to read back %s : %s" % (device, str(e)))
+			time.sleep(1)
 	
-	def _ejectTray(self):
-		os.system("eject")
+	def _verifyDisc(self, digests, device):
+		"""Reads the disc in device back and checks it against digests. Raises IOError if it doesn't match."""
+		self.logMsg("Verifying the disc in %s" % device)
+		startTime = time.time()
+		fd = self._openDisc(device)
+		try:
+			try:
+				digests.check(fd)
+			except OSError, e:
+				raise IOError("Error reading back %s : %s" % (device, str(e)))
+		except IOError:
+			self.metrics.count("verify_failures_total")
+			raise
+		finally:
+			os.close(fd)
+		elapsed = max(time.time() - startTime, 0.001)
+		self.metrics.observe("verify_seconds", elapsed)
+		self.metrics.setGauge("verify_bytes_per_second", digests.size/elapsed)
+		self.logMsg("Disc in %s matches its image, read back at %.1f KB/s" % (device, digests.size/1024/elapsed))
 	
-	def _retractTray(self):
-		os.system("eject -t")
+	def _burnFailed(self, fn, digestsPath):
+		"""Counts a failed verification of the ISO fn, giving up on it after MAX_BURN_ATTEMPTS."""
+		attempts = self._failedBurns.get(fn, 0) + 1
+		self._failedBurns[fn] = attempts
+		if attempts < self.MAX_BURN_ATTEMPTS:
+			self.logMsg("Keeping %s to burn again, %u of %u attempts used" % (fn, attempts, self.MAX_BURN_ATTEMPTS))
+			return
+		failedFn = fn.replace("discburn-iso-", "discburn-failed-", 1)
+		self.logMsg("Giving up on %s after %u bad discs, renamed it to %s" % (fn, attempts, failedFn))
+		os.rename(os.path.join(self.workingDir, fn), os.path.join(self.workingDir, failedFn))
+		if os.path.exists(digestsPath):
+			os.unlink(digestsPath)
+		del self._failedBurns[fn]
 	
-	def _burnIso(self, fn):
+	def _burnIso(self, fn, device):
 		isoPath = os.path.join(self.workingDir, fn)
 		if not os.path.exists(isoPath):
 			raise IOError("No such file %s" % isoPath)
+		digestsPath = os.path.join(self.workingDir, fn.replace("discburn-iso-", "discburn-digests-", 1))
 		
+		startTime = time.time()
 		try:
-			proc = subprocess.Popen(
-				("wodim", "-tao", "speed=10", "dev=/dev/cdrw", isoPath),
+			proc = self.startChild(
+				("wodim", "-tao", "speed=10", "dev=%s" % device, isoPath),
 				stdin = subprocess.PIPE,
 				stdout = subprocess.PIPE,
-				stderr = subprocess.STDOUT
+				stderr = subprocess.STDOUT,
+				close_fds = True
 			)
 		except OSError, e:
 			raise IOError("Unable to run wodim : %s" % str(e))
 		
 		(stdout, stderr) = proc.communicate()
+		self.metrics.observe("wodim_seconds", time.time() - startTime)
 		if proc.returncode != 0:
 			raise IOError("Wodim reported an error! Return code %s, output %s" % (proc.returncode, stdout))
 		
+		if self.VERIFY:
+			if os.path.exists(digestsPath):
+				digests = BlockDigests.load(digestsPath)
+			else:
+				digests = BlockDigests.fromImage(isoPath) # ISOs from before digests were recorded
+			try:
+				self._verifyDisc(digests, device)
+			except IOError:
+				self._burnFailed(fn, digestsPath)
+				raise
+		
 		self.logMsg("Burn of %s completed successfully, deleting ISO" % fn)
+		if self.store is not None:
+			self.store.moveFiles([fn], "burned", fn)
 		os.unlink(isoPath)
+		if os.path.exists(digestsPath):
+			os.unlink(digestsPath)
+		self._failedBurns.pop(fn, None)
 		
 		return True
 	
-	def doStuff(self):
-		while True:
-			event = self.pullEvent()
-			if event is not None and event == "EatButtonPushed":
-				self.fed = None # The user says that they've put in a blank disc, but they aren't necessarily trustworthy, so let's check
-			
-			if self.fed is None:
-				self.statusMsg("Please wait, checking disc...")
-			
-			if self.fed is None:
-				# We don't know if we are fed. Let's retract the tray so that we can see what the disc actually is.
-				self.logMsg("Fed status is unknown. Attempting to retract before scanning.")
-				self._retractTray()
-				time.sleep(4)
-			
-			cdStatus = self._checkCd()
+	def _burnStream(self, fn, device):
+		"""Burns a discburn-stream-* path list on the fly, piping genisoimage's output into wodim through a bounded buffer.
+		
+		If anything goes wrong, including the buffer running dry, the path list is handed back to IsobuildProcess as an
+		isobuild-stage-* file so that the disc is built as an ordinary ISO file instead."""
+		planPath = os.path.join(self.workingDir, fn)
+		startTime = time.time()
+		try:
+			digests = self._streamToBurner(planPath, device)
+			self.metrics.observe("stream_burn_seconds", time.time() - startTime)
+			if self.VERIFY:
+				self._verifyDisc(digests, device)
+		except IOError:
+			self.metrics.count("stream_burn_failures_total")
+			os.rename(planPath, os.path.join(self.workingDir, fn.replace("discburn-stream-", "isobuild-stage-", 1)))
+			self.logMsg("Handed %s back to IsobuildProcess to be built as an ISO file" % fn)
+			raise
+		
+		self.logMsg("Burn of %s completed successfully, deleting its items" % fn)
+		if self.store is not None:
+			self.store.moveFiles([fn], "burned", fn)
+		for (name, itemPath) in readPathList(planPath):
+			if os.path.exists(itemPath):
+				os.unlink(itemPath)
+		os.unlink(planPath)
+		
+		return True
+	
+	def _streamToBurner(self, planPath, device):
+		"""Burns the disc described by a path list on the fly. Returns the BlockDigests of the image, worked out as it went past."""
+		isoArgs = ("genisoimage", "-l", "-r", "-J", "-graft-points", "-quiet", "-path-list", planPath)
+		
+		# wodim needs to know the size of the track up front when it reads from a pipe
+		try:
+			proc = self.startChild(isoArgs + ("-print-size",), stdout = subprocess.PIPE, stderr = subprocess.STDOUT, close_fds = True)
+		except OSError, e:
+			raise IOError("Unable to run genisoimage : %s" % str(e))
+		(stdout, stderr) = proc.communicate()
+		m = re.search(r"(\d+)\s*$", stdout)
+		if proc.returncode != 0 or m is None:
+			raise IOError("Genisoimage couldn't work out the image size! Return code %s, output %s" % (proc.returncode, stdout))
+		sectors = int(m.group(1))
+		
+		buf = Queue.Queue(max(self.STREAM_BUFFER_SIZE//self.STREAM_CHUNK_SIZE, 1))
+		isoErrors = tempfile.TemporaryFile()
+		try:
+			isoProc = self.startChild(isoArgs, stdout = subprocess.PIPE, stderr = isoErrors, close_fds = True)
+		except OSError, e:
+			raise IOError("Unable to run genisoimage : %s" % str(e))
+		def produce():
+			while True:
+				chunk = isoProc.stdout.read(self.STREAM_CHUNK_SIZE)
+				buf.put(chunk) # An empty chunk marks the end of the image
+				if not chunk:
+					break
+		producer = threading.Thread(target = produce)
+		producer.setDaemon(True)
+		producer.start()
+		
+		wodimProc = None
+		wodimOutput = tempfile.TemporaryFile()
+		digests = BlockDigests()
+		try:
+			# Let the buffer fill up before the burn starts
+			while not buf.full() and producer.isAlive():
+				time.sleep(0.1)
 			
-			if cdStatus == 0:
-				# Blank CD is inserted.
-				self.fed = True
-			elif cdStatus == 1:
-				# There's a non-blank CD inserted
-				self.logMsg("Non-blank CD currently inserted, setting fed status to False and ejecting tray.")
-				self.fed = False
-				self._ejectTray() # Eject the tray so that the user can extract the burned disc
-			elif cdStatus == 2:
-				# There's no CD inserted, or the tray is ejected
-				if self.fed is not True:
-					if self.fed is None:
-						self.logMsg("Updating unknown Fed status to False; tray is presumably closed yet still can't find any medium.")
-						self.fed = False
-					self._ejectTray() # Force the tray to stay ejected until the user clicks the 'Eat!' button
+			try:
+				wodimProc = self.startChild(
+					("wodim", "-tao", "speed=10", "dev=%s" % device, "driveropts=burnfree", "tsize=%us" % sectors, "-"),
+					stdin = subprocess.PIPE,
+					stdout = wodimOutput,
+					stderr = subprocess.STDOUT,
+					close_fds = True
+				)
+			except OSError, e:
+				raise IOError("Unable to run wodim : %s" % str(e))
 			
-			if self.fed is True:
-				self.statusMsg("System OK.\n\nNo action required.")
-			else:
-				self.statusMsg("Action required! Feed me! Feed me!\n\n\nStep 1: If there is a disc on the tray, put it into a sleeve.\n\n\nStep 2: Place a blank disc onto the tray, label side up, then click the 'Eat!' button.")
+			while True:
+				try:
+					chunk = buf.get(timeout = self.UNDERRUN_TIMEOUT)
+				except Queue.Empty:
+					self.metrics.count("stream_underruns_total")
+					raise IOError("Buffer underrun, genisoimage couldn't keep up with wodim")
+				if not chunk:
+					break
+				digests.update(chunk)
+				try:
+					wodimProc.stdin.write(chunk)
+				except (IOError, OSError):
+					break # Wodim has quit; its return code will say why
+			wodimProc.stdin.close()
+			wodimProc.wait()
+			if not chunk:
+				isoProc.wait() # It has already written everything, so this won't block
+		finally:
+			for p in (isoProc, wodimProc):
+				if p is not None and p.poll() is None:
+					os.kill(p.pid, signal.SIGTERM)
+					p.wait()
+			while producer.isAlive():
+				try:
+					buf.get_nowait() # Unblock the producer so it can see that genisoimage is gone
+				except Queue.Empty:
+					time.sleep(0.05)
+		
+		if wodimProc.returncode != 0:
+			wodimOutput.seek(0)
+			raise IOError("Wodim reported an error! Return code %s, output %s" % (wodimProc.returncode, wodimOutput.read()))
+		if isoProc.returncode != 0:
+			isoErrors.seek(0)
+			raise IOError("Genisoimage reported an error! Return code %s, output %s" % (isoProc.returncode, isoErrors.read()))
+		digests.finish()
+		return digests
+	
+	def _claimJob(self):
+		"""Returns the next image for a drive to burn, or None if there isn't one. ISO files go before on-the-fly burns."""
+		self._jobLock.acquire()
+		try:
+			while len(self._pending) > 0:
+				fn = self._pending.pop(0)
+				if self._jobExists(fn): # It may have been burned since the list was made
+					self._claimed.add(fn)
+					return fn
+			return None
+		finally:
+			self._jobLock.release()
+	
+	def _jobExists(self, fn):
+		return os.path.exists(os.path.join(self.workingDir, fn))
+	
+	def _releaseJob(self, fn):
+		self._jobLock.acquire()
+		try:
+			self._claimed.discard(fn)
+		finally:
+			self._jobLock.release()
+	
+	def _updatePending(self):
+		isos = self.watcher.files("discburn-iso-")
+		streams = self.watcher.files("discburn-stream-")
+		self.metrics.setGauge("queue_depth", len(isos) + len(streams))
+		self._jobLock.acquire()
+		try:
+			self._pending = [fn for fn in isos + streams if fn not in self._claimed]
+		finally:
+			self._jobLock.release()
+	
+	def _probeAfterLoad(self, monitor):
+		"""Probes a drive whose tray has just been retracted, as soon as it has loaded the disc."""
+		deadline = time.time() + self.LOAD_TIMEOUT
+		delay = 0.25
+		while True:
+			ready = monitor.ready()
+			if ready is not False:
+				self.metrics.count("media_probes_total")
+				cdStatus = monitor.probe()
+				# If the monitor can't tell when loading has finished, "no medium" may just mean it hasn't yet
+				if cdStatus != 2 or ready is True or time.time() >= deadline:
+					return cdStatus
+			elif time.time() >= deadline:
+				self.metrics.count("media_probes_total")
+				return monitor.probe()
+			time.sleep(delay)
+			delay = min(delay*2, 2)
+	
+	def _checkDrive(self, drive, monitor):
+		"""Works out whether the drive has a blank disc, ejecting the tray if the user needs to put one in. Returns True if it's ready to burn."""
+		if drive.eatRequested:
+			drive.eatRequested = False
+			if drive.fed is not True:
+				drive.fed = None # The user says that they've put in a blank disc, but they aren't necessarily trustworthy, so let's check
+		
+		if drive.fed is None:
+			# We don't know if we are fed. Let's retract the tray so that we can see what the disc actually is.
+			drive.status = "Checking disc..."
+			self.logMsg("Fed status of %s is unknown. Attempting to retract before scanning." % drive.device)
+			self._retractTray(drive.device)
+			monitor.changed() # Don't count our own retraction as a change
+			drive.media = self._probeAfterLoad(monitor)
+		elif monitor.changed() or drive.media is None:
+			self.metrics.count("media_probes_total")
+			drive.media = monitor.probe()
+		else:
+			return drive.fed is True and drive.media == 0 # Nothing has happened since the last look
+		
+		cdStatus = drive.media
+		if cdStatus == 0:
+			# Blank CD is inserted.
+			drive.fed = True
+		elif cdStatus == 1:
+			# There's a non-blank CD inserted
+			self.logMsg("Non-blank CD currently inserted in %s, setting fed status to False and ejecting tray." % drive.device)
+			drive.fed = False
+			self._ejectTray(drive.device) # Eject the tray so that the user can extract the burned disc
+		elif cdStatus == 2:
+			# There's no CD inserted, or the tray is ejected
+			if drive.fed is not True:
+				if drive.fed is None:
+					self.logMsg("Updating unknown Fed status of %s to False; tray is presumably closed yet still can't find any medium." % drive.device)
+					drive.fed = False
+				self._ejectTray(drive.device) # Force the tray to stay ejected until the user clicks the 'Eat!' button
+		if cdStatus != 0:
+			monitor.changed() # Don't count our own ejection as a change
+		
+		if drive.fed is True:
+			drive.status = "Blank disc ready"
+		else:
+			drive.status = "Needs a blank disc"
+		return cdStatus == 0
+	
+	def _runDrive(self, drive):
+		try:
+			monitor = openMediaMonitor(drive.device, self.MEDIA_MONITOR)
+			self.logMsg("Watching %s with a %s" % (drive.device, monitor.__class__.__name__))
+			while not self._stopRequested:
+				ready = self._checkDrive(drive, monitor)
+				self._reportStatus()
+				if ready:
+					self.watcher.refresh()
+					self._updatePending()
+					fn = self._claimJob()
+					if fn is not None:
+						try:
+							drive.status = "Burning %s" % fn
+							self._reportStatus()
+							try:
+								if fn.startswith("discburn-iso-"):
+									self.logMsg("Attempting to burn %s in %s" % (fn, drive.device))
+									self._burnIso(fn, drive.device)
+								else:
+									self.logMsg("Attempting to burn %s on the fly in %s" % (fn, drive.device))
+									self._burnStream(fn, drive.device)
+							except IOError, e:
+								self.logMsg("Error burning %s - %s" % (fn, str(e)))
+						finally:
+							self._releaseJob(fn)
+						# Whether or not the burn succeeded, it's now time to insert a new blank disc.
+						drive.fed = False
+						drive.media = 2
+						drive.status = "Needs a blank disc"
+						self._ejectTray(drive.device)
+						monitor.changed() # Don't count our own ejection as a change
+						continue
+				time.sleep(self.POLL_INTERVAL)
+		except StageStopped:
+			pass
+		except:
+			drive.error = traceback.format_exc()
+	
+	def _statusText(self):
+		hungry = [drive.device for drive in self.drives if drive.fed is not True]
+		if None in [drive.fed for drive in self.drives]:
+			return "Please wait, checking disc..."
+		elif len(hungry) == 0:
+			return "System OK.\n\nNo action required."
+		msg = "Action required! Feed me! Feed me!\n\n\nStep 1: If there is a disc on the tray, put it into a sleeve.\n\n\nStep 2: Place a blank disc onto the tray, label side up, then click the 'Eat!' button."
+		if len(self.drives) > 1:
+			msg += "\n\nDrives needing a disc: %s" % ", ".join(hungry)
+		return msg
+	
+	def _reportStatus(self):
+		"""Sends the status message and the drive states to the controller, if they've changed since they were last sent."""
+		self._statusLock.acquire()
+		try:
+			status = self._statusText()
+			if status != self._lastStatus:
+				self.statusMsg(status)
+				self._lastStatus = status
+			drives = [(drive.device, drive.status) for drive in self.drives]
+			if drives != self._lastDrives:
+				self.channel.send("drives", self.__class__.__name__, drives)
+				self._lastDrives = drives
+		finally:
+			self._statusLock.release()
+	
+	def doStuff(self):
+		for drive in self.drives:
+			self.startThread(self._runDrive, (drive,))
+		
+		# The drive threads watch the drives and the working directory themselves, so this one only waits for the 'Eat!' button
+		while True:
+			self.watcher.refresh()
+			self._updatePending()
+			self._reportStatus()
+			event = self.waitForEvent(self.METRICS_INTERVAL)
+			if event == "EatButtonPushed":
+				for drive in self.drives:
+					drive.eatRequested = True
 			
-			if cdStatus == 0:
-				isos = []
-				for fn in os.listdir(self.workingDir):
-					if fn.startswith("discburn-iso-"):
-						isos.append(fn)
-				isos.sort()
-				if len(isos) > 0:
+			for drive in self.drives:
+				if drive.error is not None:
+					raise IOError("Thread for drive %s died:\n%s" % (drive.device, drive.error))
+
+
+class StageThread(threading.Thread):
+	"""Runs an AudreyProcess in a thread of the current process rather than in a process of its own.
+	
+	Has the parts of the processing.Process interface that AudreyController uses, so the two can be used interchangeably.
+	terminate() can't kill a thread, so instead it asks the stage to stop, and wakes it if it's asleep in waitForFiles() or
+	waitForEvent(). A busy stage stops the next time it calls pullEvent().
+	"""
+	
+	def __init__(self, stage):
+		threading.Thread.__init__(self, name = stage.__class__.__name__)
+		self.setDaemon(True)
+		self.stage = stage
+	
+	def run(self):
+		self.stage.run()
+	
+	def terminate(self):
+		self.stage._stopRequested = True
+		self.stage._eventQueue.put("Stop")
+		watcher = self.stage.watcher
+		if watcher is not None:
+			watcher.wake()
+	
+	def getPid(self):
+		return os.getpid()
+
+
+class LogWriter:
+	"""Appends messages to a log file from a background thread, so that callers never block on disk.
+	
+	Messages are batched and written once FLUSH_BYTES of them are waiting or FLUSH_INTERVAL seconds have passed.
+	When the file grows beyond maxBytes it's rotated to <path>.1.gz, keeping at most backups compressed files.
+	If jsonLines is True (and the json module is available), each message is written as a JSON object instead of a line of text.
+	"""
+	
+	FLUSH_BYTES = 64*1024 # Write out the batch once this much text is waiting
+	FLUSH_INTERVAL = 1 # Write out the batch at least this often, in seconds
+	
+	def __init__(self, path, maxBytes = 10*1024*1024, backups = 5, jsonLines = False):
+		self._path = path
+		self._maxBytes = maxBytes
+		self._backups = backups
+		self._jsonLines = jsonLines and json is not None
+		self._queue = Queue.Queue()
+		self._fh = open(self._path, "a")
+		self._thread = threading.Thread(target = self._run)
+		self._thread.setDaemon(True)
+		self._thread.start()
+	
+	def write(self, msg, source = None):
+		"""Queues a message for the log. source is the name of the process the message came from, if any."""
+		self._queue.put((time.time(), source, msg))
+	
+	def close(self):
+		"""Writes out any waiting messages and closes the file."""
+		self._queue.put(None)
+		self._thread.join()
+	
+	def _format(self, entry):
+		(t, source, msg) = entry
+		if self._jsonLines:
+			return json.dumps({"time": t, "source": source, "msg": msg}) + "\n"
+		if source is not None:
+			msg = "%s: %s" % (source, msg)
+		return "%s  %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), msg)
+	
+	def _rotate(self):
+		self._fh.close()
+		try:
+			for n in range(self._backups - 1, 0, -1):
+				if os.path.exists("%s.%u.gz" % (self._path, n)):
+					os.rename("%s.%u.gz" % (self._path, n), "%s.%u.gz" % (self._path, n+1))
+			if self._backups > 0:
+				src = open(self._path, "rb")
+				try:
+					dest = gzip.open("%s.1.gz" % self._path, "wb")
 					try:
-						self.logMsg("Attempting to burn %s" % isos[0])
-						self._burnIso(isos[0])
-					except IOError, e:
-						self.logMsg("Error burning %s - %s" % (isos[0], str(e)))
-					# Whether or not the burn succeeded, it's now time to insert a new blank disc.
-					self.fed = False
-					self._ejectTray()
+						shutil.copyfileobj(src, dest)
+					finally:
+						dest.close()
+				finally:
+					src.close()
+			os.unlink(self._path)
+		finally:
+			self._fh = open(self._path, "a")
+	
+	def _run(self):
+		batch = []
+		batchBytes = 0
+		deadline = None
+		done = False
+		while not done:
+			try:
+				if deadline is None:
+					entry = self._queue.get()
+				else:
+					entry = self._queue.get(True, max(deadline - time.time(), 0))
+				if entry is None:
+					done = True
+				else:
+					line = self._format(entry)
+					batch.append(line)
+					batchBytes += len(line)
+					if deadline is None:
+						deadline = time.time() + self.FLUSH_INTERVAL
+			except Queue.Empty:
+				pass
 			
-			time.sleep(0.5)
+			if len(batch) > 0 and (done or batchBytes >= self.FLUSH_BYTES or time.time() >= deadline):
+				try:
+					self._fh.write("".join(batch))
+					self._fh.flush()
+					if self._fh.tell() >= self._maxBytes:
+						self._rotate()
+				except (IOError, OSError), e:
+					# There's nowhere to report this but stderr; drop the batch rather than let it grow forever
+					print >>sys.stderr, "Unable to write to log %s : %s" % (self._path, str(e))
+				batch = []
+				batchBytes = 0
+				deadline = None
+		self._fh.close()
 
 
 class AudreyController:
 	"""Class that starts up and runs the various audrey processes.
 	
-	Instantiate this class and then call start(). After that, periodically call pump() to get new status messages and keep everything going.
+	Instantiate this class and then call start(). After that, call pump() whenever one of filenos() becomes readable to get new status messages,
+	and at least every PUMP_INTERVAL seconds to notice dead subprocesses and keep everything going. wait() does this for loops without a GUI.
+	
+	The subprocesses' metrics are written in Prometheus text format to the METRICS_FILE in the working directory,
+	and are also served at http://localhost:METRICS_PORT/metrics if METRICS_PORT is set.
+	
+	If a subprocess dies, pump() restarts just that one after a delay, leaving the others running. The restarted
+	process carries on from the working files. The delay doubles with each death in quick succession, and if a
+	subprocess dies CRASH_LOOP_DEATHS times within CRASH_LOOP_WINDOW seconds, pump() gives up on the whole lot.
 	"""
 	
-	def __init__(self):
+	METRICS_FILE = "metrics.prom" # Name of the metrics file in the working directory, or None to not write one
+	METRICS_PORT = None # Serve metrics over HTTP on this localhost port, or None to not serve them
+	METRICS_INTERVAL = 10 # Rewrite the metrics file this often, in seconds
+	PUMP_INTERVAL = 1 # Maximum time between calls to pump() when no messages are arriving, in seconds
+	SINGLE_PROCESS = False # Run the stages as threads of the controller's process instead of as separate processes, to save memory
+	LOG_MAX_BYTES = 10*1024*1024 # Rotate the log once it's this big
+	LOG_BACKUPS = 5 # Number of compressed old logs to keep
+	LOG_JSON = False # Write the log as JSON lines instead of plain text
+	RESTART_DELAY = 1 # Wait this many seconds before restarting a subprocess that died
+	RESTART_MAX_DELAY = 120 # Never wait longer than this many seconds before a restart
+	CRASH_LOOP_DEATHS = 5 # Stop restarting if a subprocess dies this many times...
+	CRASH_LOOP_WINDOW = 600 # ...within this many seconds
+	STOP_TIMEOUT = AudreyProcess.STOP_TIMEOUT + 5 # When stopping, wait at most this long for the subprocesses to stop their workers and exit, in seconds
+	
+	def __init__(self, workingDir = None):
+		"""Creates the controller. workingDir defaults to ~/audrey-working."""
 		socket.setdefaulttimeout(60)
 
 		# Create the working directory if necessary
-		self._workingDir = os.path.expanduser("~/audrey-working")
+		self._workingDir = workingDir or os.path.expanduser("~/audrey-working")
 		if not os.path.isdir(self._workingDir):
 			try:
 				os.mkdir(self._workingDir)
@@ -483,62 +3475,176 @@ class AudreyController:
 		if not os.path.isdir(self._workingDir):
 			raise IOError("Unable to find or create directory \"%s\"" % self._workingDir)
 		
-		# Delete any left-over temp files from possible prior crashes
+		# Delete any left-over temp files and space reservations from possible prior crashes
 		for fn in os.listdir(self._workingDir):
-			if fn.startswith("temp-"):
+			if fn.startswith("temp-") or fn.startswith("space-reserve-"):
 				os.unlink(os.path.join(self._workingDir, fn))
 
-		self.currentEvent = None
-		
 		self._statusMsg = "Initializing controller..."
-		self._subprocs = [
+		self._driveStatus = []
+		self._log = LogWriter(os.path.join(self._workingDir, "log"), self.LOG_MAX_BYTES, self.LOG_BACKUPS, self.LOG_JSON)
+		self._metrics = {} # Maps stage names to their latest Metrics snapshots
+		self._lastMetricsWrite = 0
+		self._channels = [] # One MessageChannel for each stage
+		self._deaths = {} # Maps stage indexes to the times that stage's subprocess died
+		self._restartTimes = {} # Maps the indexes of dead stages to the time they're due to be restarted
+		self._restartCounts = {} # Maps stage indexes to the number of times they've been restarted
+		self._stages = [
 			FeedchkProcess(self._workingDir),
 			FetchProcess(self._workingDir),
 			IsobuildProcess(self._workingDir),
 			DiscburnProcess(self._workingDir),
 		]
+		if FetchProcess.TRANSCODE:
+			self._stages.insert(2, TranscodeProcess(self._workingDir))
+		for stage in self._stages:
+			stage.channel = MessageChannel()
+			self._channels.append(stage.channel)
+		self._subprocs = [self._wrapStage(stage) for stage in self._stages]
+	
+	def _wrapStage(self, stage):
+		"""Returns the object to start for a stage: the stage itself, or a StageThread running it if SINGLE_PROCESS is set."""
+		if self.SINGLE_PROCESS:
+			return StageThread(stage)
+		return stage
 	
-	def _addToLog(self, msg):
-		fn = file(os.path.join(self._workingDir, "log"), "a")
-		fn.write("%s  %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), msg))
-		fn.close()
+	def _addToLog(self, msg, source = None):
+		self._log.write(msg, source)
 	
 	def pushEvent(self, eventMsg):
-		"""Adds a string to be sent to all the subprocesses as an event. Only the most recent event between checks reaches each subprocess."""
-		self.currentEvent = eventMsg
+		"""Sends a string to all the subprocesses as an event. Only the most recent event between checks reaches each subprocess."""
+		for stage in self._stages:
+			stage._eventQueue.put(eventMsg)
+	
+	def driveStatus(self):
+		"""Returns a list of (device, status string) tuples for the burner drives, as of the last pump()."""
+		return self._driveStatus
+	
+	def filenos(self):
+		"""Returns the file descriptors that become readable when pump() has messages to process. They change when a stage is restarted."""
+		return [channel.fileno() for channel in self._channels]
+	
+	def wait(self, timeout = None):
+		"""Blocks until there are messages for pump() or timeout seconds pass. timeout defaults to PUMP_INTERVAL."""
+		if timeout is None:
+			timeout = self.PUMP_INTERVAL
+		try:
+			select.select(self._channels, [], [], timeout)
+		except select.error:
+			pass # Interrupted by a signal
 	
 	def start(self):
 		self._addToLog("AudreyController starting")
+		store = openStateStore(self._workingDir, AudreyProcess.USE_STATE_STORE)
+		if store is not None:
+			pending = store.pendingByStage()
+			self._addToLog("Items by stage: %s" % ", ".join(["%s %u" % (stage, pending[stage]) for stage in sorted(pending)]))
+			store.close() # Each subprocess opens its own connection
 		for p in self._subprocs:
 			p.start()
+		if self.METRICS_PORT is not None:
+			server = BaseHTTPServer.HTTPServer(("127.0.0.1", self.METRICS_PORT), MetricsHandler)
+			server.controller = self
+			t = threading.Thread(target = server.serve_forever)
+			t.setDaemon(True)
+			t.start()
+	
+	def metricsText(self):
+		"""Returns the latest metrics from every subprocess in Prometheus text format."""
+		return formatMetrics(dict(self._metrics))
+	
+	def _writeMetrics(self):
+		tempPath = os.path.join(self._workingDir, "temp-%s" % self.METRICS_FILE)
+		fh = open(tempPath, "w")
+		try:
+			fh.write(self.metricsText())
+		finally:
+			fh.close()
+		os.rename(tempPath, os.path.join(self._workingDir, self.METRICS_FILE))
+	
+	def stop(self):
+		"""Terminates all the subprocesses, waits up to STOP_TIMEOUT seconds for them to exit, and closes the log."""
+		self._addToLog("AudreyController stopping")
+		self._stopStages()
+	
+	def _stopStages(self):
+		for p in self._subprocs:
+			if p.isAlive():
+				p.terminate()
+		deadline = time.time() + self.STOP_TIMEOUT
+		for p in self._subprocs:
+			p.join(max(deadline - time.time(), 0))
+		for stage in self._stages:
+			stage._eventQueue.close() # Lets its feeder thread exit now rather than die at interpreter shutdown
+		for channel in self._channels:
+			self._receive(channel) # The stages' last messages, for the log
+		stuck = [stage.__class__.__name__ for (stage, p) in zip(self._stages, self._subprocs) if p.isAlive()]
+		if len(stuck) > 0:
+			self._addToLog("Stages still running after %u seconds, giving up on them: %s" % (self.STOP_TIMEOUT, ", ".join(stuck)))
+		self._log.close()
+	
+	def _stageDied(self, i, now):
+		"""Schedules a restart of the stage at index i, or raises RuntimeError if it's in a crash loop."""
+		name = self._stages[i].__class__.__name__
+		deaths = [t for t in self._deaths.get(i, []) if t > now - self.CRASH_LOOP_WINDOW] + [now]
+		self._deaths[i] = deaths
+		if len(deaths) >= self.CRASH_LOOP_DEATHS:
+			self._addToLog("Subprocess %s died %u times in %u seconds, killing all subprocesses and raising RuntimeError" % (name, len(deaths), self.CRASH_LOOP_WINDOW))
+			self._stopStages()
+			raise RuntimeError("Subprocess %s keeps dying" % name)
+		delay = min(self.RESTART_DELAY*2**(len(deaths) - 1), self.RESTART_MAX_DELAY)
+		self._addToLog("Subprocess %s died, restarting it in %u seconds" % (name, delay))
+		self._restartTimes[i] = now + delay
+	
+	def _restartStage(self, i):
+		"""Replaces the dead stage at index i with a fresh instance and starts it, after deleting its left-over temp files and space reservations."""
+		old = self._stages[i]
+		self._subprocs[i].join() # The stage stops its workers and child processes on the way out
+		for fn in os.listdir(self._workingDir):
+			if fn.startswith(old.TEMP_PREFIXES + ("space-reserve-%s-" % old.__class__.__name__,)):
+				os.unlink(os.path.join(self._workingDir, fn))
+		self._receive(self._channels[i]) # Anything the old stage sent before it died
+		self._channels[i].close()
+		stage = old.__class__(self._workingDir)
+		stage.channel = MessageChannel()
+		self._channels[i] = stage.channel
+		self._restartCounts[i] = self._restartCounts.get(i, 0) + 1
+		stage.metrics.count("restarts_total", self._restartCounts[i]) # Counters start again from zero in the new process, so carry this one over
+		self._stages[i] = stage
+		self._subprocs[i] = self._wrapStage(stage)
+		self._subprocs[i].start()
+		self._addToLog("Restarted subprocess %s" % stage.__class__.__name__)
+	
+	def _receive(self, channel):
+		for (kind, source, payload) in channel.receive():
+			if kind == "status":
+				self._statusMsg = payload
+			elif kind == "log":
+				self._addToLog(payload, source)
+			elif kind == "drives":
+				self._driveStatus = payload
+			elif kind == "metrics":
+				self._metrics[source] = payload
 	
 	def pump(self):
 		"""Checks for messages from the subprocesses and returns the current status string.
 		
 		Raises RuntimeError if something unrecoverably bad happened since the last pump()."""
-		for p in self._subprocs:
-			try:
-				while True:
-					self._statusMsg = p._statusQueue.get_nowait()
-			except Queue.Empty:
-				pass
-			
-			try:
-				while True:
-					self._addToLog("%s: %s" % (p.__class__.__name__, p._logQueue.get_nowait()))
-			except Queue.Empty:
-				pass
-			
-			if self.currentEvent is not None:
-				for p in self._subprocs:
-					p._eventQueue.put(self.currentEvent)
-				self.currentEvent = None
-			
-			if not p.isAlive():
-				self._addToLog("Subprocess %s died, killing all subprocesses and raising RuntimeError" % p.__class__.__name__)
-				for p in self._subprocs:
-					p.terminate()
-				raise RuntimeError("Subprocess died")
+		for channel in self._channels:
+			self._receive(channel)
+		
+		now = time.time()
+		for i in range(len(self._stages)):
+			if i in self._restartTimes:
+				if now >= self._restartTimes[i]:
+					del self._restartTimes[i]
+					self._restartStage(i)
+			elif not self._subprocs[i].isAlive():
+				self._stageDied(i, now)
+		
+		if self.METRICS_FILE is not None and time.time() - self._lastMetricsWrite >= self.METRICS_INTERVAL:
+			self._writeMetrics()
+			self._lastMetricsWrite = time.time()
 		
 		return self._statusMsg
 
@@ -546,6 +3652,9 @@ class AudreyController:
 if __name__ == "__main__":
 	controller = AudreyController()
 	controller.start()
-	while True:
-		controller.pump()
-		time.sleep(0.1)
+	try:
+		while True:
+			controller.wait()
+			controller.pump()
+	finally:
+		controller.stop() # Writes out the rest of the log
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+"""Time-warp simulator for IsobuildProcess's disc building policy.
+
+Replays an arrival trace of episodes against a virtual clock and an in-memory working directory. The real stages make
+the decisions: IsobuildProcess._chooseDisc() picks each disc to build, and DiscburnProcess._claimJob() hands the
+built images to the drives. The simulator models the rest. Burns take a fixed time, and a user feeds every drive that
+needs a blank disc every so often. Months of operation take seconds, since the clock jumps straight from one event to
+the next: an arrival, a finished burn, a visit from the user, or an item's age passing REQ_DAYS or TRIP_DAYS.
+
+Reports disc fill ratio, publish-to-burn latency and discs per month for each policy given with --policy, for example
+	simulate.py --policy REQ_SIZE=300 --policy TRIP_DAYS=10,TRIP_SIZE=500
+
+The trace is either synthetic, or read from a CSV file with a header and the columns time, feed and size_mb, where time is
+seconds since the epoch or "YYYY-MM-DD HH:MM". Run with --help to see the options.
+"""
+
+from __future__ import division
+
+import optparse, random, heapq, csv, time, calendar, datetime, sys
+
+from lib import *
+
+
+POLICY_KEYS = ("REQ_DAYS", "REQ_SIZE", "TRIP_DAYS", "TRIP_SIZE", "MAX_SIZE")
+DAY = 60*60*24
+MONTH = DAY*30
+
+
+def syntheticTrace(options):
+	"""Returns a list of (publish time, feed, size in MB) tuples for options.feeds feeds over options.months months, oldest first."""
+	rand = random.Random(options.seed)
+	trace = []
+	for feed in range(options.feeds):
+		period = rand.uniform(options.minCadence, options.maxCadence)*DAY
+		t = rand.uniform(0, period)
+		while t < options.months*MONTH:
+			size = rand.lognormvariate(0, 0.4)*options.sizeMb
+			trace.append((t, "feed%03u" % feed, size))
+			t += period*rand.uniform(0.9, 1.1)
+	trace.sort()
+	return trace
+
+
+def readTrace(path):
+	"""Returns a list of (publish time, feed, size in MB) tuples from a CSV trace file, oldest first, with times starting from 0."""
+	trace = []
+	fh = open(path)
+	try:
+		for row in csv.DictReader(fh):
+			when = row["time"].strip()
+			try:
+				t = float(when)
+			except ValueError:
+				t = calendar.timegm(time.strptime(when, "%Y-%m-%d %H:%M"))
+			trace.append((t, row["feed"].strip(), float(row["size_mb"])))
+	finally:
+		fh.close()
+	if len(trace) == 0:
+		raise IOError("No episodes in trace %s" % path)
+	trace.sort()
+	start = trace[0][0]
+	return [(t - start, feed, size) for (t, feed, size) in trace]
+
+
+def parsePolicy(spec):
+	"""Returns a dictionary of IsobuildProcess settings from a "NAME=value,..." string, starting from the current settings."""
+	settings = dict([(key, getattr(IsobuildProcess, key)) for key in POLICY_KEYS])
+	for part in [p for p in spec.split(",") if p.strip()]:
+		(key, value) = [x.strip() for x in part.split("=", 1)]
+		if key not in POLICY_KEYS:
+			raise ValueError("Unknown policy setting %s, should be one of %s" % (key, ", ".join(POLICY_KEYS)))
+		settings[key] = float(value)
+	return settings
+
+
+class SimulatedWorkingDir:
+	"""Stands in for a WorkingDirWatcher, with the working files kept in memory instead of on disk."""
+	
+	def __init__(self):
+		self.index = {} # Maps file names to (size in bytes, mtime) tuples
+	
+	def files(self, prefix = ""):
+		return sorted([fn for fn in self.index if fn.startswith(prefix)])
+	
+	def stat(self, fn):
+		return self.index.get(fn)
+	
+	def refresh(self):
+		pass
+
+
+class SimulatedDiscburnProcess(DiscburnProcess):
+	"""A DiscburnProcess whose images live in a SimulatedWorkingDir. Only its job queue is used; it's never started."""
+	
+	def _jobExists(self, fn):
+		return self.watcher.stat(fn) is not None
+
+
+class Simulation:
+	"""Runs one policy over a trace. Call run(), then look at the discs and latencies attributes."""
+	
+	def __init__(self, trace, settings, options):
+		# Only the first planned disc is ever built, and DiscPlanner plans it without looking at the others
+		policy = type("SimulatedIsobuildProcess", (IsobuildProcess,), dict(settings, PLAN_AHEAD = 1))
+		workingDir = SimulatedWorkingDir()
+		self.isobuild = policy(None) # Never started; just for its decisions
+		self.isobuild.watcher = workingDir
+		self.discburn = SimulatedDiscburnProcess(None)
+		self.discburn.watcher = workingDir
+		self.discburn.drives = [BurnerDrive("drive%u" % i) for i in range(options.drives)]
+		for drive in self.discburn.drives:
+			drive.fed = True
+		self.workingDir = workingDir
+		self.settings = settings
+		self.trace = trace
+		self.options = options
+		self.now = 0
+		self.published = {} # Maps item and image names to the publish times of the episodes in them
+		self.burning = set() # Devices of the drives that are burning
+		self.discs = [] # (size in MB, burn finish time) for each burned disc
+		self.latencies = [] # Publish-to-burn latency of each burned item, in days
+		self._events = [] # Heap of (time, sequence number, kind, data) tuples
+		self._sequence = 0
+		self._checks = set() # Times at which a "check" event is already scheduled
+	
+	def _schedule(self, when, kind, data = None):
+		self._sequence += 1
+		heapq.heappush(self._events, (when, self._sequence, kind, data))
+	
+	def _build(self):
+		"""Builds discs for as long as IsobuildProcess._chooseDisc() says to, as IsobuildProcess.doStuff() would."""
+		while True:
+			discs = self.isobuild._chooseDisc(self.isobuild._waitingItems(self.now))
+			if discs is None:
+				break
+			(toBurn, totalSize) = discs[0]
+			# Named like the real images, so that DiscburnProcess takes them in the same order; the sequence number keeps them apart
+			isoFn = "discburn-iso-%s-%06u.iso" % (str(datetime.datetime.utcfromtimestamp(self.now)).replace(" ", "-"), self._sequence)
+			self._sequence += 1
+			self.workingDir.index[isoFn] = (totalSize*1024*1024, self.now)
+			self.published[isoFn] = []
+			for f in toBurn:
+				self.published[isoFn].extend(self.published.pop(f[0]))
+				del self.workingDir.index[f[0]]
+		
+		# The decision can next change when an item's age passes one of the thresholds, which _shouldBuild() compares with >
+		for (size, fetched) in [self.workingDir.index[fn] for fn in self.workingDir.files("isobuild-item-")]:
+			for days in (self.settings["REQ_DAYS"], self.settings["TRIP_DAYS"]):
+				when = fetched + days*DAY + 1
+				if when > self.now and when not in self._checks:
+					self._checks.add(when)
+					self._schedule(when, "check")
+	
+	def _dispatch(self):
+		"""Hands images to drives that have a blank disc and aren't burning, as DiscburnProcess's drive threads would."""
+		for drive in self.discburn.drives:
+			if drive.fed is True and drive.device not in self.burning:
+				self.discburn._updatePending()
+				fn = self.discburn._claimJob()
+				if fn is None:
+					break
+				self.burning.add(drive.device)
+				self._schedule(self.now + self.options.burnMinutes*60, "burned", (drive, fn))
+	
+	def run(self):
+		for (published, feed, size) in self.trace:
+			self._schedule(published + self.options.fetchHours*60*60, "arrive", (published, size))
+		end = self.trace[-1][0] + self.options.drainDays*DAY
+		self._schedule(self.options.userHours*60*60, "visit")
+		n = 0
+		while len(self._events) > 0:
+			(when, sequence, kind, data) = heapq.heappop(self._events)
+			if when > end:
+				break
+			self.now = when
+			if kind == "arrive":
+				n += 1
+				fn = "isobuild-item-%06u" % n
+				self.workingDir.index[fn] = (data[1]*1024*1024, when)
+				self.published[fn] = [data[0]]
+			elif kind == "check":
+				self._checks.discard(when)
+			elif kind == "burned":
+				(drive, fn) = data
+				self.discburn._releaseJob(fn)
+				self.burning.discard(drive.device)
+				drive.fed = False # The drive now needs a new blank disc
+				self.discs.append((self.workingDir.index.pop(fn)[0]/(1024*1024), when))
+				self.latencies.extend([(when - published)/DAY for published in self.published.pop(fn)])
+			elif kind == "visit":
+				for drive in self.discburn.drives:
+					drive.fed = True
+				self._schedule(when + self.options.userHours*60*60, "visit")
+			self._build()
+			self._dispatch()
+
+
+def summarize(values):
+	"""Returns a (mean, median, 90th percentile, max) tuple for a list of numbers."""
+	if len(values) == 0:
+		return (0, 0, 0, 0)
+	values = sorted(values)
+	return (sum(values)/len(values), values[len(values)//2], values[int(len(values)*0.9)], values[-1])
+
+
+def runSimulations(options, policies):
+	if options.trace is not None:
+		trace = readTrace(options.trace)
+		source = options.trace
+	else:
+		trace = syntheticTrace(options)
+		source = "synthetic, %u feeds publishing every %g-%g days, %g MB episodes, seed %u" % (
+			options.feeds, options.minCadence, options.maxCadence, options.sizeMb, options.seed,
+		)
+	months = max(trace[-1][0]/MONTH, 1/30)
+	print "Trace: %s" % source
+	print "%u episodes, %.1f GB over %.1f months; fetched %g h after publishing, %u drive(s), %g min per burn, blank discs fed every %g h" % (
+		len(trace), sum([t[2] for t in trace])/1024, months, options.fetchHours, options.drives, options.burnMinutes, options.userHours,
+	)
+	print
+	print "%-40s %6s %9s %9s %10s %10s %10s %10s %9s" % (
+		"Policy", "Discs", "Discs/mo", "Fill (%)", "Lat mean", "Lat med", "Lat p90", "Lat max", "Unburned",
+	)
+	for (name, settings) in policies:
+		startTime = time.time()
+		sim = Simulation(trace, settings, options)
+		sim.run()
+		fill = [100*size/settings["MAX_SIZE"] for (size, when) in sim.discs]
+		print "%-40s %6u %9.2f %9.1f %10.2f %10.2f %10.2f %10.2f %9u" % (
+			(name[:40], len(sim.discs), len(sim.discs)/months, (fill and sum(fill)/len(fill)) or 0)
+			+ summarize(sim.latencies)
+			+ (len(trace) - len(sim.latencies),)
+		)
+		if options.verbose:
+			print "  simulated in %.2f s" % (time.time() - startTime)
+	print
+	print "Latencies are in days from publishing to the end of the burn. Discs/mo is over the trace's span."
+
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage = "%prog [options]")
+	parser.add_option("--policy", action = "append", default = [], help = "a policy to try, as NAME=value pairs separated by commas, overriding the current "
+		"IsobuildProcess settings of %s; may be given several times [the current settings]" % ", ".join(POLICY_KEYS))
+	parser.add_option("--trace", help = "read the arrival trace from this CSV file instead of making one up")
+	parser.add_option("--feeds", type = "int", default = 20, help = "number of synthetic feeds [%default]")
+	parser.add_option("--months", type = "float", default = 6, help = "length of the synthetic trace in months [%default]")
+	parser.add_option("--min-cadence", dest = "minCadence", type = "float", default = 1, help = "shortest synthetic publishing interval in days [%default]")
+	parser.add_option("--max-cadence", dest = "maxCadence", type = "float", default = 14, help = "longest synthetic publishing interval in days [%default]")
+	parser.add_option("--size-mb", dest = "sizeMb", type = "float", default = 40, help = "typical synthetic episode size in MB [%default]")
+	parser.add_option("--seed", type = "int", default = 1, help = "random seed for the synthetic trace [%default]")
+	parser.add_option("--fetch-hours", dest = "fetchHours", type = "float", default = 2, help = "time from publishing to the item reaching the isobuild process [%default]")
+	parser.add_option("--drives", type = "int", default = 1, help = "number of burner drives [%default]")
+	parser.add_option("--burn-minutes", dest = "burnMinutes", type = "float", default = 10, help = "time to burn and verify one disc [%default]")
+	parser.add_option("--user-hours", dest = "userHours", type = "float", default = 24, help = "the user feeds every hungry drive this often [%default]")
+	parser.add_option("--drain-days", dest = "drainDays", type = "float", default = 30, help = "keep going this long after the last episode [%default]")
+	parser.add_option("--verbose", action = "store_true", default = False, help = "also show how long each simulation took")
+	(options, args) = parser.parse_args()
+
+	policies = []
+	for spec in options.policy or [""]:
+		try:
+			policies.append((spec or "current", parsePolicy(spec)))
+		except ValueError, e:
+			parser.error(str(e))
+	try:
+		runSimulations(options, policies)
+	except (IOError, KeyError), e:
+		print >>sys.stderr, "Unable to read trace: %s" % str(e)
+		sys.exit(1)
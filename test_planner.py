@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+"""Tests for DiscPlanner. Run with "python test_planner.py"."""
+
+from __future__ import division
+
+import unittest, random
+
+from lib import *
+
+
+class DiscPlannerTest(unittest.TestCase):
+	def _items(self, count, minSize, maxSize, seed = 1):
+		rand = random.Random(seed)
+		return [("item%03u" % i, rand.uniform(minSize, maxSize), rand.uniform(0, 10)) for i in range(count)]
+	
+	def _checkPlan(self, fileDescs, discs, maxSize):
+		seen = set()
+		for (disc, total) in discs:
+			self.assertTrue(len(disc) > 0)
+			self.assertAlmostEqual(total, sum([f[1] for f in disc]))
+			self.assertTrue(total < maxSize)
+			for f in disc:
+				self.assertTrue(f[0] not in seen)
+				seen.add(f[0])
+	
+	def testFillsDiscsWithSmallItems(self):
+		items = self._items(400, 2, 5)
+		discs = DiscPlanner(600).plan(items, 2)
+		self._checkPlan(items, discs, 600)
+		self.assertEqual(len(discs), 2)
+		for (disc, total) in discs:
+			self.assertTrue(total > 598, total)
+	
+	def testFillsDiscsAtLeastAsWellAsFirstFitDecreasing(self):
+		for seed in range(5):
+			items = self._items(60, 20, 120, seed)
+			planner = DiscPlanner(600)
+			disc = planner.plan(items, 1)[0]
+			oldest = max(items, key = lambda f: f[2])
+			rest = [f for f in items if f is not oldest]
+			greedy = oldest[1] + sum([f[1] for f in planner._firstFitDecreasing(rest, 600 - oldest[1])])
+			self.assertTrue(disc[1] >= greedy - 2048/(1024*1024)*len(disc[0]), (disc[1], greedy))
+	
+	def testOldestItemGoesFirst(self):
+		items = self._items(50, 10, 100)
+		oldest = max(items, key = lambda f: f[2])
+		discs = DiscPlanner(600).plan(items, 1)
+		self.assertTrue(oldest in discs[0][0])
+	
+	def testOverdueItemsGoOnFirstDisc(self):
+		items = self._items(50, 10, 50)
+		overdue = [f for f in items if f[2] > 8]
+		discs = DiscPlanner(600, 8).plan(items, 1)
+		for f in overdue:
+			self.assertTrue(f in discs[0][0])
+	
+	def testLeavesOutItemsTooBigForAnyDisc(self):
+		discs = DiscPlanner(100).plan([("big", 150, 5), ("small", 30, 1)])
+		self.assertEqual(discs, [([("small", 30, 1)], 30)])
+	
+	def testStopsWhenNothingMoreFits(self):
+		discs = DiscPlanner(10).plan([("a", 10, 1), ("b", 0, 0.5)])
+		self.assertEqual(len(discs), 1)
+		discs = DiscPlanner(10).plan([("a", 9.9999, 1), ("b", 9.9999, 0.5)], 5)
+		self.assertEqual(len(discs), 1)
+		self.assertEqual(DiscPlanner(10).plan([]), [])
+	
+	def testPlansEveryItemWithoutALimit(self):
+		items = self._items(100, 5, 50)
+		discs = DiscPlanner(200).plan(items)
+		self._checkPlan(items, discs, 200)
+		self.assertEqual(sum([len(disc) for (disc, total) in discs]), len(items))
+	
+	def testFallsBackToFirstFitDecreasingForManyItems(self):
+		items = self._items(DiscPlanner.MAX_EXACT_ITEMS + 100, 2, 5)
+		discs = DiscPlanner(600).plan(items, 3)
+		self._checkPlan(items, discs, 600)
+		self.assertEqual(len(discs), 3)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+
+"""Tests for StateStore. Run with "python test_statestore.py"."""
+
+import unittest, tempfile, shutil
+
+from lib import *
+
+
+class StateStoreTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.store = StateStore(self.dir)
+	
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.dir)
+	
+	def testPendingByStageLeavesOutFinishedItems(self):
+		for i in range(5):
+			self.store.addItem("key%u" % i, "feed", "http://example.com/%u.mp3" % i, "Item %u" % i, i, "fetch-desc-%u" % i)
+		self.store.setStage("key1", "transcode", "transcode-src-1")
+		self.store.setStage("key2", "transcode", "transcode-src-2")
+		self.store.setStage("key3", "burned", "discburn-iso-1")
+		self.store.setStage("key4", "dropped", None)
+		self.assertEqual(self.store.pendingByStage(), {"fetch": 1, "transcode": 2})
+	
+	def testPendingByStageIsEmptyWhenEverythingIsBurned(self):
+		self.store.addItem("key", "feed", "http://example.com/a.mp3", "A", 0, "fetch-desc-a")
+		self.store.moveFiles(["fetch-desc-a"], "burned", "discburn-iso-1")
+		self.assertEqual(self.store.pendingByStage(), {})
+
+
+if __name__ == "__main__":
+	unittest.main()